@@ -0,0 +1,217 @@
+#!/usr/bin/python
+import argparse
+from glob import glob
+import json
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import timeit
+import xml.sax.handler
+
+from indexer import WikiHandler, parse_dump
+from processing import VOCABULARY, process_data
+from search import SearchHandler
+from synthetic_dump import SyntheticDump, write_dump
+
+# Direction of each compared metric, 1 when higher is better and -1 when lower is better
+METRICS = {
+    "process_data.pages_per_sec": 1,
+    "process_data.postings_per_sec": 1,
+    "index.pages_per_sec": 1,
+    "index.merge_mb_per_sec": 1,
+    "index.peak_rss_mb": -1,
+    "query.p50_ms": -1,
+    "query.p95_ms": -1,
+    "query.p99_ms": -1,
+    "query.queries_per_sec": 1,
+}
+
+
+class PageCollector(xml.sax.handler.ContentHandler):
+    """Collect the (title, text) of the pages of a dump"""
+
+    def __init__(self, max_pages: int):
+        super().__init__()
+        self.max_pages = max_pages
+        self.pages = []
+        self.field = None
+        self.title = ""
+        self.text = ""
+
+    def startElement(self, tag, attributes):
+        if tag in ("title", "text"):
+            self.field = tag
+
+    def characters(self, content):
+        if self.field == "title":
+            self.title += content
+        elif self.field == "text":
+            self.text += content
+
+    def endElement(self, tag):
+        if tag in ("title", "text"):
+            self.field = None
+        elif tag == "page":
+            if len(self.pages) < self.max_pages:
+                self.pages.append((self.title.lower(), self.text))
+            self.title = ""
+            self.text = ""
+
+
+def percentile(values: list, fraction: float) -> float:
+    """Nearest rank percentile of sorted values"""
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def peak_rss_mb() -> float:
+    """Largest resident set size of this process and of its finished child processes"""
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+def benchmark_processing(path_to_dump: str, max_pages: int) -> dict:
+    """Pages and postings per second of process_data alone"""
+    collector = PageCollector(max_pages)
+    xml.sax.parse(path_to_dump, collector)
+    postings = 0
+    start = timeit.default_timer()
+    for doc_id, (title, text) in enumerate(collector.pages, 1):
+        postings += len(process_data(ID=doc_id, title=title, text=text))
+    seconds = timeit.default_timer() - start
+    VOCABULARY.reset()
+    return {"pages": len(collector.pages), "seconds": seconds, "pages_per_sec": len(collector.pages) / seconds,
+            "postings_per_sec": postings / seconds}
+
+
+def run_index(path_to_dump: str, path_to_index: str, options: dict, results) -> None:
+    """Build an index in a fresh process so that its peak memory is not inflated by the benchmark itself"""
+    handler = WikiHandler(path_to_index=path_to_index, path_to_stat=os.path.join(path_to_index, 'stats.txt'),
+                          **options)
+    start = timeit.default_timer()
+    parse_dump(handler, path_to_dump)
+    stage1_seconds = timeit.default_timer() - start
+    stage1_bytes = sum(os.path.getsize(path) for path in glob(os.path.join(path_to_index, 'index1_*.txt')))
+    start = timeit.default_timer()
+    handler.merge_files()
+    merge_seconds = timeit.default_timer() - start
+    index_bytes = sum(os.path.getsize(path) for path in glob(os.path.join(path_to_index, '*')))
+    results.put({"pages": handler.total_page_count, "stage1_seconds": stage1_seconds,
+                 "pages_per_sec": handler.total_page_count / stage1_seconds, "stage1_bytes": stage1_bytes,
+                 "merge_seconds": merge_seconds, "merge_mb_per_sec": stage1_bytes / (1 << 20) / merge_seconds,
+                 "index_bytes": index_bytes, "peak_rss_mb": peak_rss_mb()})
+
+
+def benchmark_index(path_to_dump: str, path_to_index: str, options: dict) -> dict:
+    """Stage 1 pages per second through WikiHandler, stage 2 merge throughput and peak memory of an index build"""
+    if os.path.exists(path_to_index):
+        shutil.rmtree(path_to_index)
+    os.makedirs(path_to_index)
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_index, args=(path_to_dump, path_to_index, options, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def benchmark_queries(path_to_index: str, queries: list, cache_mb: int, warmup: int = 10) -> dict:
+    """Latency percentiles of a query mix run through SearchHandler"""
+    handler = SearchHandler(path_to_index, cache_bytes=cache_mb << 20)
+    for query in queries[:warmup]:
+        handler.search(query)
+    latencies = []
+    for query in queries:
+        start = timeit.default_timer()
+        handler.search(query)
+        latencies.append((timeit.default_timer() - start) * 1000)
+    latencies.sort()
+    return {"queries": len(latencies), "p50_ms": percentile(latencies, .5), "p95_ms": percentile(latencies, .95),
+            "p99_ms": percentile(latencies, .99), "mean_ms": sum(latencies) / len(latencies),
+            "queries_per_sec": len(latencies) / (sum(latencies) / 1000)}
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """Print the change of each metric against a baseline report and return the metrics which regressed by more
+    than the tolerance"""
+    regressions = []
+    for metric, direction in METRICS.items():
+        section, name = metric.split(".")
+        if name not in report.get(section, {}) or name not in baseline.get(section, {}):
+            continue
+        old, new = baseline[section][name], report[section][name]
+        change = (new - old) / old if old else 0
+        is_regression = change * direction < -tolerance
+        print(f"{metric:32} {old:12.3f} {new:12.3f} {change:+8.1%}{'  REGRESSION' if is_regression else ''}")
+        if is_regression:
+            regressions.append(metric)
+    return regressions
+
+
+def parse_args() -> argparse.Namespace:
+    arg_parser = argparse.ArgumentParser(description="Benchmark the indexing and the search on a synthetic dump")
+    arg_parser.add_argument("path_to_work", help="directory for the generated dump and the index")
+    arg_parser.add_argument("--dump", default=None, help="benchmark this dump instead of a synthetic one")
+    arg_parser.add_argument("--pages", type=int, default=10000, help="number of pages of the synthetic dump")
+    arg_parser.add_argument("--seed", type=int, default=1, help="seed of the synthetic dump and query mix")
+    arg_parser.add_argument("--process-pages", type=int, default=2000,
+                            help="number of pages used for the process_data benchmark")
+    arg_parser.add_argument("--queries", type=int, default=500, help="number of queries of the synthetic query mix")
+    arg_parser.add_argument("--query-file", default=None, help="file of queries, one per line, to use instead")
+    arg_parser.add_argument("--cache-mb", type=int, default=0, help="size of the postings cache during queries")
+    arg_parser.add_argument("--postings", choices=["text", "binary"], default="text")
+    arg_parser.add_argument("--workers", type=int, default=1)
+    arg_parser.add_argument("--memory-mb", type=float, default=256)
+    arg_parser.add_argument("--skip", nargs="*", default=[], choices=["process_data", "index", "query"],
+                            help="benchmarks to leave out")
+    arg_parser.add_argument("--output", default="benchmark.json", help="file the JSON report is written to")
+    arg_parser.add_argument("--compare", default=None, help="JSON report of a previous run to compare against")
+    arg_parser.add_argument("--tolerance", type=float, default=.1,
+                            help="relative change of a metric in the wrong direction reported as a regression")
+    return arg_parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    os.makedirs(args.path_to_work, exist_ok=True)
+    path_to_dump = args.dump
+    if path_to_dump is None:
+        path_to_dump = os.path.join(args.path_to_work, f"synthetic_{args.pages}_{args.seed}.xml")
+        if not os.path.exists(path_to_dump):
+            write_dump(path_to_dump, args.pages, seed=args.seed)
+    path_to_index = os.path.join(args.path_to_work, "index")
+
+    report = {"config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+              "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                              "cpus": os.cpu_count()}}
+    if "process_data" not in args.skip:
+        report["process_data"] = benchmark_processing(path_to_dump, args.process_pages)
+    if "index" not in args.skip:
+        report["index"] = benchmark_index(path_to_dump, path_to_index, {
+            "postings_format": args.postings, "workers": args.workers, "memory_mb": args.memory_mb})
+    if "query" not in args.skip:
+        if args.query_file is not None:
+            with open(args.query_file, 'r') as f:
+                queries = [line.rstrip() for line in f if line.strip()]
+        else:
+            dump = SyntheticDump(seed=args.seed)
+            queries = [dump.query() for _ in range(args.queries)]
+        report["query"] = benchmark_queries(path_to_index, queries, args.cache_mb)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps({key: value for key, value in report.items() if key != "config"}, indent=2))
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        if len(compare(report, baseline, args.tolerance)):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+from collections import OrderedDict
+import json
+import sqlite3
+import sys
+import time
+
+
+def postings_size(docs: list, tfs: list) -> int:
+    """Approximate memory taken by a decoded postings list, doc ids are int objects while small counts are shared"""
+    return sys.getsizeof(docs) + sys.getsizeof(tfs) + 32 * len(docs)
+
+
+def results_size(results: list) -> int:
+    """Approximate memory taken by the (doc id, score, title, page id) results of a query"""
+    return sys.getsizeof(results) + sum(120 + len(result[2]) for result in results)
+
+
+class LRUCache:
+    """Least recently used cache bounded by the approximate size of its entries in bytes, entries expire ttl seconds
+    after they are put if a ttl is given"""
+
+    def __init__(self, max_bytes: int, ttl: float = None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Cached value of the key or None, a hit makes the entry the most recently used"""
+        entry = self.entries.get(key)
+        if entry is not None and entry[2] is not None and entry[2] < time.time():
+            self.size -= self.entries.pop(key)[1]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value, size: int, expires: float = None) -> None:
+        """Insert an entry and evict the least recently used entries until the cache fits its budget, entries larger
+        than the whole budget are not cached. The entry expires at the given time, or after the ttl"""
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        if expires is None and self.ttl:
+            expires = time.time() + self.ttl
+        self.entries[key] = (value, size, expires)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, evicted_size, _) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self) -> dict:
+        return {"entries": len(self.entries), "bytes": self.size, "max_bytes": self.max_bytes, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions}
+
+
+class ResultCache:
+    """Results of normalized queries for one generation of the index, kept in a size and ttl bounded LRU cache and,
+    if a path is given, in a SQLite file which persists them across restarts. Changing the generation drops the
+    results of the older generations"""
+
+    def __init__(self, max_bytes: int, ttl: float = None, path: str = None):
+        self.memory = LRUCache(max_bytes, ttl=ttl)
+        self.ttl = ttl
+        self.generation = None
+        self.disk_hits = 0
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, generation TEXT, expires REAL, "
+                            "results TEXT)")
+
+    def set_generation(self, generation: str) -> None:
+        if generation == self.generation:
+            return
+        self.generation = generation
+        self.memory.clear()
+        if self.db is not None:
+            with self.db:
+                self.db.execute("DELETE FROM results WHERE generation != ?", (generation,))
+
+    def get(self, key: tuple):
+        """Cached results of a normalized query or None, results found on disk are also kept in memory"""
+        results = self.memory.get(key)
+        if results is not None or self.db is None:
+            return results
+        row = self.db.execute("SELECT expires, results FROM results WHERE key = ? AND generation = ?",
+                              (json.dumps(key), self.generation)).fetchone()
+        if row is None or (row[0] is not None and row[0] < time.time()):
+            return None
+        self.disk_hits += 1
+        results = [tuple(result) for result in json.loads(row[1])]
+        self.memory.put(key, results, results_size(results), expires=row[0])
+        return results
+
+    def put(self, key: tuple, results: list) -> None:
+        self.memory.put(key, results, results_size(results))
+        if self.db is not None:
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                                (json.dumps(key), self.generation, time.time() + self.ttl if self.ttl else None,
+                                 json.dumps(results)))
+
+    def stats(self) -> dict:
+        return dict(self.memory.stats(), disk_hits=self.disk_hits, generation=self.generation)
@@ -0,0 +1,186 @@
+#!/usr/bin/python
+import argparse
+import asyncio
+import heapq
+from itertools import chain
+import json
+import multiprocessing
+import os
+import timeit
+
+from search import SearchHandler, format_results
+from server import SearchServer, check_request, connect, error_response
+
+
+def serve_shard(conn, path_to_index: str, cache_bytes: int, scoring: str, io_workers: int) -> None:
+    """Answer the requests of the coordinator on a local shard in a worker process, until it sends None"""
+    server = SearchServer(SearchHandler(path_to_index, cache_bytes=cache_bytes, scoring=scoring,
+                                        io_workers=io_workers))
+    while (request := conn.recv()) is not None:
+        try:
+            conn.send(server.answer(request))
+        except Exception as e:
+            conn.send(error_response(e))
+
+
+class LocalShard:
+    """Shard searched by a worker process of the coordinator"""
+
+    def __init__(self, path_to_index: str, cache_bytes: int, scoring: str, io_workers: int):
+        self.conn, worker_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=serve_shard, args=(worker_conn, path_to_index, cache_bytes,
+                                                                         scoring, io_workers), daemon=True)
+        self.process.start()
+
+    def send(self, request: dict) -> None:
+        self.conn.send(request)
+
+    def receive(self) -> dict:
+        return self.conn.recv()
+
+    def close(self) -> None:
+        self.conn.send(None)
+        self.process.join()
+
+
+class RemoteShard:
+    """Shard searched by a search server, over a connection kept open between queries"""
+
+    def __init__(self, address: str):
+        self.conn = connect(address)
+        self.file = self.conn.makefile('rwb')
+
+    def send(self, request: dict) -> None:
+        self.file.write(json.dumps(request).encode() + b"\n")
+        self.file.flush()
+
+    def receive(self) -> dict:
+        return json.loads(self.file.readline())
+
+    def close(self) -> None:
+        self.file.close()
+        self.conn.close()
+
+
+class ShardCoordinator(SearchServer):
+    """Scatter-gather server over the shards of a sharded index, answering the same requests as a search server"""
+
+    def __init__(self, shards: list):
+        super().__init__(None)
+        self.shards = shards
+
+    def scatter(self, request: dict) -> list:
+        """Send a request to all the shards, which answer it in parallel, and gather their responses"""
+        sent = []
+        responses = []
+        for shard in self.shards:
+            try:
+                shard.send(request)
+                sent.append(shard)
+            except Exception as e:
+                responses.append(error_response(e))
+        # every shard sent the request is read even if another one failed, so the next responses stay in order
+        for shard in sent:
+            try:
+                responses.append(shard.receive())
+            except Exception as e:
+                responses.append(error_response(e))
+        for response in responses:
+            if "error" in response:
+                raise ValueError(response["error"])
+        return responses
+
+    def search(self, query: str, k: int = 10, mode: str = None) -> list:
+        """Rank a query on all the shards with the statistics summed over them and merge their top results"""
+        request = {"query": query, "k": k, "mode": mode}
+        stats = {"pages": 0, "length": 0, "df": {}}
+        shard_numbers = []
+        for response in self.scatter(dict(request, collect=True)):
+            stats["pages"] += response["stats"]["pages"]
+            stats["length"] += response["stats"]["length"]
+            for word, doc_freq in response["stats"]["df"].items():
+                stats["df"][word] = stats["df"].get(word, 0) + doc_freq
+            shard_numbers.append((response["stats"]["shard"], response["stats"]["shards"]))
+        if sorted(shard_numbers) != [(shard, len(self.shards)) for shard in range(len(self.shards))]:
+            raise ValueError(f"the shards {sorted(shard_numbers)} do not make up a whole index")
+
+        responses = self.scatter(dict(request, **{"global": stats}))
+        return heapq.nsmallest(k, chain.from_iterable(response["results"] for response in responses),
+                               key=lambda result: (-result["score"], result["doc_id"]))
+
+    def answer(self, request: dict) -> dict:
+        k = check_request(request)
+        with self.lock:
+            if request.get("stats"):
+                return {"shards": self.scatter({"stats": True})}
+            start = timeit.default_timer()
+            results = self.search(str(request["query"]), k, request.get("mode"))
+            stop = timeit.default_timer()
+        return {"results": results, "time": stop - start}
+
+    def parse_query_file(self, query_file: str, mode: str = None) -> None:
+        """Run the queries of a file and write their results to query_op.txt like the search"""
+        with open(query_file, 'r') as f, open("query_op.txt", 'w') as out:
+            for _query in f:
+                start = timeit.default_timer()
+                results = self.search(_query.rstrip(), mode=mode)
+                out.write(format_results([(result["doc_id"], result["score"], result["title"], result["page_id"])
+                                          for result in results], timeit.default_timer() - start))
+
+    def close(self) -> None:
+        for shard in self.shards:
+            shard.close()
+
+
+def open_shards(specs: list, cache_bytes: int, scoring: str, io_workers: int) -> list:
+    """Shards given as index directories or packs, which are searched by local worker processes, directories of
+    shard_N indexes written by the indexer, or addresses of search servers"""
+    shards = []
+    for spec in specs:
+        if os.path.isdir(os.path.join(spec, "shard_0")):
+            names = sorted((name for name in os.listdir(spec) if name.startswith("shard_")),
+                           key=lambda name: int(name.split("_")[1]))
+            shards.extend(LocalShard(os.path.join(spec, name), cache_bytes, scoring, io_workers) for name in names)
+        elif os.path.isdir(spec) or os.path.isfile(spec):
+            shards.append(LocalShard(spec, cache_bytes, scoring, io_workers))
+        else:
+            shards.append(RemoteShard(spec))
+    return shards
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(usage="python3 coordinator.py shard [shard ...] "
+                                               "(--serve host:port|unix_socket_path | --query-file queries.txt) "
+                                               "[options]")
+    arg_parser.add_argument("shards", nargs="+",
+                            help="shard index, directory of shards or host:port or unix socket of a shard server")
+    arg_parser.add_argument("--serve", default=None, help="address the coordinator serves queries on")
+    arg_parser.add_argument("--query-file", default=None, help="run the queries of a file instead of serving them")
+    arg_parser.add_argument("--and", dest="conjunctive", action="store_true",
+                            help="only return documents holding all the words of the query")
+    arg_parser.add_argument("--cache-mb", type=float, default=256,
+                            help="memory budget of the postings cache of each local shard, 0 disables it")
+    arg_parser.add_argument("--scoring", choices=["bm15", "bm25"], default="bm15",
+                            help="scoring of the local shards, shard servers use their own")
+    arg_parser.add_argument("--io-workers", type=int, default=8,
+                            help="number of threads of each local shard reading the postings lists and titles of a "
+                                 "query concurrently")
+    args = arg_parser.parse_args()
+    if (args.serve is None) == (args.query_file is None):
+        arg_parser.error("give either --serve or --query-file")
+
+    coordinator = ShardCoordinator(open_shards(args.shards, int(args.cache_mb * 1e6), args.scoring, args.io_workers))
+    try:
+        if args.query_file is not None:
+            coordinator.parse_query_file(args.query_file, mode="and" if args.conjunctive else None)
+        else:
+            print(f"Coordinating {len(coordinator.shards)} shards on {args.serve}")
+            asyncio.run(coordinator.serve(args.serve))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        coordinator.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import bz2
+from collections import deque
+import multiprocessing
+import os
+
+STREAM_MAGIC = b"\x31\x41\x59\x26\x53\x59"
+SCAN_SIZE = 1 << 24
+READ_SIZE = 1 << 20
+
+
+def default_index_path(path_to_dump: str):
+    """Path of the -index.txt.bz2 companion of a multistream dump if it exists"""
+    if not path_to_dump.endswith(".xml.bz2"):
+        return None
+    index_path = path_to_dump[:-len(".xml.bz2")] + "-index.txt.bz2"
+    return index_path if os.path.exists(index_path) else None
+
+
+def read_index_offsets(index_path: str) -> set:
+    """Stream offsets listed in the index of a multistream dump, each line is offset:page_id:title"""
+    offsets = set()
+    with bz2.open(index_path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            offsets.add(int(line.split(":", 1)[0]))
+    return offsets
+
+
+def scan_stream_offsets(path_to_dump: str) -> set:
+    """Find the bz2 streams of a dump by scanning for the stream header followed by the first block magic"""
+    offsets = set()
+    overlap = len(STREAM_MAGIC) + 4
+    with open(path_to_dump, 'rb') as f:
+        base = 0
+        data = f.read(SCAN_SIZE)
+        while len(data) > 0:
+            pos = data.find(b"BZh")
+            while pos != -1:
+                if data[pos + 3:pos + 4].isdigit() and data[pos + 4:pos + 4 + len(STREAM_MAGIC)] == STREAM_MAGIC:
+                    offsets.add(base + pos)
+                pos = data.find(b"BZh", pos + 1)
+            next_data = f.read(SCAN_SIZE)
+            if len(next_data) == 0:
+                break
+            base += len(data) - overlap
+            data = data[-overlap:] + next_data
+    return offsets
+
+
+def stream_chunks(offsets: set, dump_size: int, chunk_size: int) -> list:
+    """Group consecutive streams into (start, end) byte ranges of about chunk_size compressed bytes"""
+    boundaries = sorted(offsets | {0, dump_size})
+    chunks = []
+    start = 0
+    for boundary in boundaries[1:]:
+        if boundary - start >= chunk_size or boundary == dump_size:
+            chunks.append((start, boundary))
+            start = boundary
+    return chunks
+
+
+def decompress_range(path_to_dump: str, start: int, end: int) -> bytes:
+    """Decompress the complete bz2 streams between two byte offsets"""
+    with open(path_to_dump, 'rb') as f:
+        f.seek(start)
+        return bz2.decompress(f.read(end - start))
+
+
+def stream_range(path_to_dump: str, start: int, end: int):
+    """Yield the decompressed data of the bz2 streams between two byte offsets in pieces, for ranges too large to
+    decompress at once"""
+    decompressor = bz2.BZ2Decompressor()
+    with open(path_to_dump, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0 and len(data := f.read(min(READ_SIZE, remaining))):
+            remaining -= len(data)
+            while len(data):
+                piece = decompressor.decompress(data)
+                data = b""
+                if decompressor.eof:
+                    data, decompressor = decompressor.unused_data, bz2.BZ2Decompressor()
+                yield piece
+
+
+def read_multistream(path_to_dump: str, index_path: str = None, workers: int = 1, chunk_size: int = 1 << 22,
+                     max_range: int = 1 << 26):
+    """Yield the decompressed XML of a bz2 multistream dump in order, independent streams are decompressed in
+    parallel by a pool of worker processes with a bounded number of chunks in flight. Chunks of more than max_range
+    compressed bytes are streamed instead, and a dump of a single stream is read through bz2.open"""
+    offsets = read_index_offsets(index_path) if index_path is not None else scan_stream_offsets(path_to_dump)
+    if len(offsets - {0}) == 0:
+        with bz2.open(path_to_dump, 'rb') as f:
+            while len(data := f.read(READ_SIZE)):
+                yield data
+        return
+
+    chunks = stream_chunks(offsets, os.path.getsize(path_to_dump), chunk_size)
+    if workers <= 1:
+        for start, end in chunks:
+            if end - start > max_range:
+                yield from stream_range(path_to_dump, start, end)
+            else:
+                yield decompress_range(path_to_dump, start, end)
+        return
+
+    with multiprocessing.Pool(workers) as pool:
+        pending = deque()
+        for start, end in chunks:
+            if end - start > max_range:
+                while len(pending):
+                    yield pending.popleft().get()
+                yield from stream_range(path_to_dump, start, end)
+                continue
+            pending.append(pool.apply_async(decompress_range, (path_to_dump, start, end)))
+            if len(pending) > 2 * workers:
+                yield pending.popleft().get()
+        while len(pending):
+            yield pending.popleft().get()
@@ -0,0 +1,474 @@
+from array import array
+from itertools import accumulate, islice
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+
+META_FILE = "index_meta.json"
+TERM_DICT_FILE = "term_dict.dat"
+LOW_TIER_DICT_FILE = "term_dict_low.dat"
+TERM_LENGTH = 20
+TERM_RECORD = struct.Struct(f"<{TERM_LENGTH}sIQIII")
+TITLE_OFFSETS_FILE = "title_offsets.dat"
+TITLE_RECORD = struct.Struct("<IQIQ")
+DOC_LENGTHS_FILE = "doc_lengths.dat"
+POSITIONS_FILE = "positions.dat"
+POSITION_OFFSETS_FILE = "position_offsets.dat"
+POSITION_RECORD = struct.Struct("<QI")
+PACK_MAGIC = b"WIKIPACK"
+PACK_VERSION = 1
+PACK_HEADER = struct.Struct("<8sIQII")
+PACK_ALIGNMENT = 8
+POSTINGS_EXTENSION = {"text": "txt", "binary": "bin"}
+FIELDS = "ticrlb"
+FIELD_BITS = {field: 1 << ind for ind, field in enumerate(FIELDS)}
+MASK_TAGS = ["".join(tag for tag in sorted(FIELDS) if mask & FIELD_BITS[tag]) for mask in range(1 << len(FIELDS))]
+BLOCK_SIZE = 128
+WIDTH_TYPECODES = ("B", "H", "I")
+
+
+def field_dict_file(field: str) -> str:
+    """Term dictionary of the postings lists restricted to one field"""
+    return f"term_dict_{field}.dat"
+
+
+def read_meta(store) -> dict:
+    """Read the index metadata of an index directory or pack, indexes without a metadata file use text postings"""
+    meta = {"postings": "text", "field_postings": False, "skips": False, "positions": False, "build_id": None,
+            "shard": 0, "shards": 1, "tiers": None}
+    if store.exists(META_FILE):
+        meta.update(json.loads(store.text(META_FILE)))
+    return meta
+
+
+def write_meta(index_path: str, meta: dict) -> None:
+    with open(os.path.join(index_path, META_FILE), 'w') as f:
+        json.dump(meta, f)
+
+
+def tags_to_mask(tags: str) -> int:
+    """Field bitmask of a string of field tags, -1 if a tag is not a field"""
+    mask = 0
+    for tag in tags:
+        if tag not in FIELD_BITS:
+            return -1
+        mask |= FIELD_BITS[tag]
+    return mask
+
+
+def encode_varint(value: int, out: bytearray) -> None:
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varint(data, pos: int) -> tuple:
+    """Decode a varint starting at pos and return it with the position after it"""
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def width_code(value: int) -> int:
+    """Smallest packed integer width able to hold the value"""
+    return 0 if value < 1 << 8 else 1 if value < 1 << 16 else 2
+
+
+def pack_ints(code: int, values: list) -> bytes:
+    packed = array(WIDTH_TYPECODES[code], values)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_ints(code: int, data, pos: int, size: int) -> array:
+    unpacked = array(WIDTH_TYPECODES[code])
+    unpacked.frombytes(data[pos:pos + size * unpacked.itemsize])
+    if sys.byteorder == "big":
+        unpacked.byteswap()
+    return unpacked
+
+
+def append_doc_lengths(index_path: str, lengths: array) -> None:
+    """Append the lengths of the next documents to the doc lengths file, 4 bytes per document"""
+    with open(os.path.join(index_path, DOC_LENGTHS_FILE), 'ab') as f:
+        f.write(pack_ints(2, lengths))
+
+
+def read_doc_lengths(store):
+    """Lengths of the documents in doc id order served from the memory map, None for indexes written without them"""
+    if not store.exists(DOC_LENGTHS_FILE):
+        return None
+    data = store.data(DOC_LENGTHS_FILE)
+    if sys.byteorder == "big":
+        return unpack_ints(2, data, 0, len(data) // 4)
+    return memoryview(data).cast("I")
+
+
+def parse_text_postings(postings: list) -> tuple:
+    """Parse text postings of the form count-docid-tags into doc ids, counts and field masks"""
+    docs, counts, masks = [], [], bytearray()
+    for _doc in postings:
+        doc = _doc.split("-")
+        counts.append(int(doc[0]))
+        docs.append(int(doc[1]))
+        masks.append(tags_to_mask(doc[2]) if len(doc) > 2 else 0)
+    return docs, counts, masks
+
+
+def encode_postings(docs: list, counts: list, masks: bytearray, skips: bool = False) -> bytes:
+    """Encode sorted postings in blocks of gap encoded doc ids, counts and one byte field masks, the doc id gaps and
+    counts of a block are packed with the smallest byte width holding all of them. With skips, postings of more than
+    one block are followed by the last doc id and the byte offset of each block, which are ignored when decoding"""
+    out = bytearray()
+    encode_varint(len(docs), out)
+    prev = 0
+    block_offsets, block_last_docs = [], []
+    for start in range(0, len(docs), BLOCK_SIZE):
+        block_offsets.append(len(out))
+        block_docs = docs[start:start + BLOCK_SIZE]
+        block_counts = counts[start:start + BLOCK_SIZE]
+        gaps = [block_docs[0] - prev] + [block_docs[ind] - block_docs[ind - 1] for ind in range(1, len(block_docs))]
+        prev = block_docs[-1]
+        block_last_docs.append(prev)
+        gap_code = width_code(max(gaps))
+        count_code = width_code(max(block_counts))
+        out.append(gap_code << 4 | count_code)
+        out += pack_ints(gap_code, gaps)
+        out += pack_ints(count_code, block_counts)
+        out += masks[start:start + BLOCK_SIZE]
+    if skips and len(block_offsets) > 1:
+        out += pack_ints(2, block_last_docs)
+        out += pack_ints(2, block_offsets)
+    return bytes(out)
+
+
+def skip_table_size(doc_freq: int) -> int:
+    """Bytes of the skip table at the end of binary postings with skips, 0 for postings of a single block"""
+    blocks = (doc_freq + BLOCK_SIZE - 1) // BLOCK_SIZE
+    return 8 * blocks if blocks > 1 else 0
+
+
+def decode_skips(data) -> tuple:
+    """Last doc ids and byte offsets of the blocks from a skip table"""
+    blocks = len(data) // 8
+    return unpack_ints(2, data, 0, blocks), unpack_ints(2, data, 4 * blocks, blocks)
+
+
+def decode_block(data, pos: int, prev: int, block_size: int, docs: list, counts: list, masks: bytearray) -> int:
+    """Decode a block following the doc id prev and append it to the postings, returns the position after it"""
+    gap_code = data[pos] >> 4
+    count_code = data[pos] & 0xf
+    pos += 1
+    gaps = unpack_ints(gap_code, data, pos, block_size)
+    pos += block_size * gaps.itemsize
+    block_counts = unpack_ints(count_code, data, pos, block_size)
+    pos += block_size * block_counts.itemsize
+    docs.extend(islice(accumulate(gaps, initial=prev), 1, None))
+    counts.extend(block_counts)
+    masks += data[pos:pos + block_size]
+    return pos + block_size
+
+
+def decode_postings(data) -> tuple:
+    """Decode binary postings into doc ids, counts and field masks"""
+    size, pos = decode_varint(data, 0)
+    docs, counts, masks = [], [], bytearray()
+    prev = 0
+    while len(docs) < size:
+        pos = decode_block(data, pos, prev, min(BLOCK_SIZE, size - len(docs)), docs, counts, masks)
+        prev = docs[-1]
+    return docs, counts, masks
+
+
+class TermDictWriter:
+    """Write the sorted term -> (file, byte offset, length, doc frequency, max count) dictionary"""
+
+    def __init__(self, path: str, size: int = None):
+        """Start a new dictionary, or continue one whose records past size bytes are dropped"""
+        if size is not None:
+            os.truncate(path, size)
+        self.file = open(path, 'wb' if size is None else 'ab')
+
+    def add(self, term: str, file_num: int, offset: int, length: int, doc_freq: int, max_count: int) -> None:
+        """Append the record of a term, terms must be added in sorted order. The max count is the largest weighted
+        count in the postings and bounds the score the term can contribute to a document"""
+        self.file.write(TERM_RECORD.pack(term.encode(), file_num, offset, length, doc_freq, max_count))
+
+    def extend(self, path: str, file_offset: int) -> None:
+        """Append the records of another term dictionary whose index files are numbered after file_offset"""
+        with open(path, 'rb') as f:
+            data = f.read()
+        for record in TERM_RECORD.iter_unpack(data):
+            self.file.write(TERM_RECORD.pack(record[0], record[1] + file_offset, *record[2:]))
+
+    def flush(self) -> int:
+        """Flush the records added so far and return the size of the dictionary"""
+        self.file.flush()
+        return self.file.tell()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class TermDictionary:
+    """Memory mapped term dictionary searched with binary search"""
+
+    def __init__(self, data):
+        self.data = data
+        self.size = len(data) // TERM_RECORD.size
+
+    def __len__(self) -> int:
+        return self.size
+
+    def term(self, ind: int) -> bytes:
+        """Padded term stored at the given record"""
+        start = ind * TERM_RECORD.size
+        return bytes(self.data[start:start + TERM_LENGTH])
+
+    def find(self, term: str) -> int:
+        """Record number of the term or -1 if the term is not in the dictionary"""
+        if len(term) > TERM_LENGTH:
+            return -1
+        key = term.encode().ljust(TERM_LENGTH, b"\0")
+        low, high = 0, self.size
+        while low < high:
+            mid = (low + high) // 2
+            if self.term(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+        return low if low < self.size and self.term(low) == key else -1
+
+    def entry(self, ind: int) -> tuple:
+        """(file, byte offset, length, doc frequency, max count) of a record"""
+        return TERM_RECORD.unpack_from(self.data, ind * TERM_RECORD.size)[1:]
+
+    def lookup(self, term: str):
+        """(file, byte offset, length, doc frequency, max count) of the term or None"""
+        ind = self.find(term)
+        return self.entry(ind) if ind != -1 else None
+
+
+def title_file(file_num: int) -> str:
+    return f"title_{file_num}.txt"
+
+
+def write_titles(index_path: str, file_num: int, titles: list, page_ids: list) -> None:
+    """Write a titles file and append the (file, byte offset, length, page id) record of each of its titles to the
+    title offsets table, a page id which is not a number is stored as 0"""
+    encoded = [title.encode() for title in titles]
+    records = bytearray()
+    offset = 0
+    for title, page_id in zip(encoded, page_ids):
+        records += TITLE_RECORD.pack(file_num, offset, len(title), int(page_id) if page_id.isdigit() else 0)
+        offset += len(title) + 1
+    with open(os.path.join(index_path, title_file(file_num)), 'wb') as f:
+        f.write(b"\n".join(encoded))
+    with open(os.path.join(index_path, TITLE_OFFSETS_FILE), 'ab') as f:
+        f.write(records)
+
+
+class TitleStore:
+    """Memory mapped title offsets table, the title of a document is read from its memory mapped titles file
+    without reading the other titles"""
+
+    def __init__(self, store):
+        self.store = store
+        self.data = store.data(TITLE_OFFSETS_FILE)
+        self.size = len(self.data) // TITLE_RECORD.size
+
+    def __len__(self) -> int:
+        return self.size
+
+    def lookup(self, doc: int) -> tuple:
+        """(title, page id) of a doc id"""
+        file_num, offset, length, page_id = TITLE_RECORD.unpack_from(self.data, (doc - 1) * TITLE_RECORD.size)
+        return bytes(self.store.data(title_file(file_num))[offset:offset + length]).decode(), page_id
+
+    def read(self, doc: int) -> tuple:
+        """(title, page id) of a doc id as lookup, with the title read by a pread which titles read by other threads
+        can overlap"""
+        file_num, offset, length, page_id = TITLE_RECORD.unpack_from(self.data, (doc - 1) * TITLE_RECORD.size)
+        return self.store.read(title_file(file_num), offset, length).decode(), page_id
+
+
+def encode_positions(fields: list) -> bytes:
+    """Compressed stemmed terms of a document, one list of terms per field in the order they were indexed"""
+    return zlib.compress("\n".join(" ".join(terms) for terms in fields).encode())
+
+
+def append_positions(index_path: str, documents: list) -> None:
+    """Append the encoded terms of the next documents to the positions file and their (byte offset, length) records
+    to the position offsets table"""
+    positions_path = os.path.join(index_path, POSITIONS_FILE)
+    offset = os.path.getsize(positions_path) if os.path.exists(positions_path) else 0
+    records = bytearray()
+    for data in documents:
+        records += POSITION_RECORD.pack(offset, len(data))
+        offset += len(data)
+    with open(positions_path, 'ab') as f:
+        f.write(b"".join(documents))
+    with open(os.path.join(index_path, POSITION_OFFSETS_FILE), 'ab') as f:
+        f.write(records)
+
+
+class PositionStore:
+    """Memory mapped stemmed terms of each document, which give the positions of the terms used to match phrases"""
+
+    def __init__(self, store):
+        self.data = {name: store.data(name) for name in (POSITIONS_FILE, POSITION_OFFSETS_FILE)}
+
+    def encoded(self, doc: int) -> bytes:
+        offset, length = POSITION_RECORD.unpack_from(self.data[POSITION_OFFSETS_FILE], (doc - 1) * POSITION_RECORD.size)
+        return self.data[POSITIONS_FILE][offset:offset + length]
+
+    def fields(self, doc: int) -> list:
+        """Stemmed terms of a local doc id, one list per field"""
+        return [field.split(" ") for field in zlib.decompress(self.encoded(doc)).decode().split("\n")]
+
+    def has_phrase(self, doc: int, phrase: list) -> bool:
+        """Whether the terms of the phrase follow each other in one of the fields of the document"""
+        for terms in self.fields(doc):
+            for start in range(len(terms) - len(phrase) + 1):
+                if terms[start] == phrase[0] and terms[start:start + len(phrase)] == phrase:
+                    return True
+        return False
+
+
+class IndexDirectory:
+    """Files of an index directory, each memory mapped on first use and kept mapped. Byte ranges can also be read
+    with pread, which releases the GIL while it waits for the disk, unlike the page faults of a memory map, so that
+    the reads of concurrent threads overlap"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.maps = {}
+        self.fds = {}
+        self.lock = threading.Lock()
+
+    def exists(self, name: str) -> bool:
+        return os.path.exists(os.path.join(self.path, name))
+
+    def data(self, name: str):
+        if name not in self.maps:
+            with open(os.path.join(self.path, name), 'rb') as f:
+                self.maps[name] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(
+                    f.fileno()).st_size else b""
+        return self.maps[name]
+
+    def read(self, name: str, offset: int, length: int) -> bytes:
+        if name not in self.fds:
+            with self.lock:
+                if name not in self.fds:
+                    self.fds[name] = os.open(os.path.join(self.path, name), os.O_RDONLY)
+        return os.pread(self.fds[name], length, offset)
+
+    def close(self) -> None:
+        """Close the files opened by read, the memory maps are released with the last reference to their data"""
+        with self.lock:
+            for fd in self.fds.values():
+                os.close(fd)
+            self.fds = {}
+
+    def text(self, name: str) -> str:
+        with open(os.path.join(self.path, name), 'r') as f:
+            return f.read()
+
+
+class IndexPack:
+    """Single file index container, memory mapped once and serving the files of the packed directory as slices"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, manifest_offset, manifest_length, manifest_crc = PACK_HEADER.unpack_from(self.map, 0)
+        if magic != PACK_MAGIC:
+            raise ValueError(f"{path} is not an index pack")
+        if version != PACK_VERSION:
+            raise ValueError(f"{path} has pack format version {version}, expected {PACK_VERSION}")
+        manifest = self.map[manifest_offset:manifest_offset + manifest_length]
+        if zlib.crc32(manifest) != manifest_crc:
+            raise ValueError(f"{path} has a corrupt manifest")
+        self.manifest = json.loads(manifest)
+        self.sections = self.manifest["sections"]
+        self.view = memoryview(self.map)
+
+    def exists(self, name: str) -> bool:
+        return name in self.sections
+
+    def data(self, name: str):
+        offset, length, _ = self.sections[name]
+        return self.view[offset:offset + length]
+
+    def read(self, name: str, offset: int, length: int) -> bytes:
+        return os.pread(self.fd, length, self.sections[name][0] + offset)
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+    def text(self, name: str) -> str:
+        return bytes(self.data(name)).decode()
+
+    def verify(self) -> list:
+        """Names of the sections whose checksum does not match their data"""
+        return [name for name, (_, _, crc) in self.sections.items() if zlib.crc32(self.data(name)) != crc]
+
+
+def open_index(path: str):
+    """Reader of the files of an index directory or of an index pack"""
+    return IndexPack(path) if os.path.isfile(path) else IndexDirectory(path)
+
+
+def write_pack(index_path: str, pack_path: str) -> dict:
+    """Copy the files of an index directory into a single pack file and return its manifest. The metadata gets a
+    build id if the index has none, so the pack can be told apart from other builds"""
+    names = sorted(name for name in os.listdir(index_path) if os.path.isfile(os.path.join(index_path, name)))
+    if TERM_DICT_FILE not in names or TITLE_OFFSETS_FILE not in names:
+        raise ValueError(f"{index_path} was written without a term dictionary or title offsets, rebuild it to pack it")
+    meta = read_meta(IndexDirectory(index_path))
+    meta["build_id"] = meta["build_id"] or os.urandom(16).hex()
+    with open(os.path.join(index_path, 'page_count.txt'), 'r') as f:
+        doc_count = int(f.readline().rstrip())
+    manifest = {"version": PACK_VERSION, "doc_count": doc_count,
+                "term_count": os.path.getsize(os.path.join(index_path, TERM_DICT_FILE)) // TERM_RECORD.size,
+                "sections": {}}
+
+    tmp_path = pack_path + ".tmp"
+    with open(tmp_path, 'wb') as out:
+        out.write(bytes(PACK_HEADER.size))
+        for name in names + ([META_FILE] if META_FILE not in names else []):
+            out.write(bytes(-out.tell() % PACK_ALIGNMENT))
+            offset = out.tell()
+            crc = 0
+            if name == META_FILE:
+                data = json.dumps(meta).encode()
+                out.write(data)
+                crc = zlib.crc32(data)
+            else:
+                with open(os.path.join(index_path, name), 'rb') as f:
+                    while chunk := f.read(1 << 20):
+                        out.write(chunk)
+                        crc = zlib.crc32(chunk, crc)
+            manifest["sections"][name] = [offset, out.tell() - offset, crc]
+        manifest_data = json.dumps(manifest).encode()
+        manifest_offset = out.tell()
+        out.write(manifest_data)
+        out.seek(0)
+        out.write(PACK_HEADER.pack(PACK_MAGIC, PACK_VERSION, manifest_offset, len(manifest_data),
+                                   zlib.crc32(manifest_data)))
+    os.replace(tmp_path, pack_path)
+    return manifest
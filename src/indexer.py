@@ -1,23 +1,78 @@
 #!/usr/bin/python
+import argparse
+from array import array
 import heapq
 from glob import glob
+import json
+import multiprocessing
 import os
 from pathlib import Path
+import re
 import resource
-import sys
+import shutil
 import timeit
+import uuid
 import xml.sax.handler
 
-from processing import process_data
-
-
-class WikiHandler(xml.sax.handler.ContentHandler):
-    """Main Indexing Class"""
-
-    def __init__(self, path_to_index: str, path_to_stat: str):
+from dump_reader import default_index_path, read_multistream
+from instrument import INSTRUMENT
+from index_format import DOC_LENGTHS_FILE, FIELD_BITS, FIELDS, LOW_TIER_DICT_FILE, MASK_TAGS, POSITION_OFFSETS_FILE, \
+    POSITIONS_FILE, POSTINGS_EXTENSION, TERM_DICT_FILE, TERM_RECORD, TITLE_OFFSETS_FILE, TermDictWriter, \
+    append_doc_lengths, append_positions, encode_postings, field_dict_file, parse_text_postings, write_meta, \
+    write_titles
+from processing import VOCABULARY, doc_length, process_data
+from runs import IO_BUFFER, PostingsAccumulator, open_run, sample_boundaries, seek_to_token
+from segments import PAGE_IDS_FILE, IndexSegment, delete_pages, manifest_lock, read_manifest, select_merge, \
+    write_manifest
+from vocabulary import Vocabulary
+
+CHECKPOINT_FILE = "checkpoint.json"
+# files appended to during stage 1, truncated to their checkpointed sizes when a run is resumed
+APPENDED_FILES = (PAGE_IDS_FILE, TITLE_OFFSETS_FILE, DOC_LENGTHS_FILE, POSITIONS_FILE, POSITION_OFFSETS_FILE)
+RUN_REGEX = re.compile(r"index1_(\d+)\.txt")
+
+
+def process_batch(index_path: str, run: int, pages: list, positions: bool) -> tuple:
+    """Process a batch of consecutive pages in a worker process and write them as one stage 1 index file"""
+    accumulator = PostingsAccumulator(VOCABULARY)
+    accumulator.reset()
+    lengths = array("I")
+    encoded_terms = [] if positions else None
+    for doc_id, title, text in pages:
+        doc_tokens = process_data(ID=doc_id, title=title, text=text, positions=encoded_terms)
+        lengths.append(doc_length(doc_tokens))
+        accumulator.add(doc_tokens)
+    with INSTRUMENT.phase("write_run"):
+        accumulator.write_run(os.path.join(index_path, f'index1_{run}.txt'))
+    return lengths, encoded_terms, INSTRUMENT.take()
+
+
+def read_checkpoint(index_path: str):
+    """Last checkpoint of an interrupted indexing run, None if there is none"""
+    checkpoint_path = os.path.join(index_path, CHECKPOINT_FILE)
+    if not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path, 'r') as f:
+        return json.load(f)
+
+
+def merge_range(path_to_index: str, run_paths: list, low: bytes, high: bytes, options: dict) -> tuple:
+    """Merge the tokens in [low, high) of the stage 1 index files into a separate stage 2 index in a worker process,
+    returns its number of index files, first words and number of tokens"""
+    os.makedirs(path_to_index, exist_ok=True)
+    handler = WikiHandler(path_to_index=path_to_index, path_to_stat=os.path.join(path_to_index, 'stats.txt'),
+                          **options)
+    handler.open_term_dicts()
+    word_count = handler.merge_runs(run_paths, low=low, high=high)
+    handler.close_term_dicts()
+    return handler.file_count, handler.stage2_first_words, word_count
+
+
+class PageReader(xml.sax.handler.ContentHandler):
+    """Read the title, id and text of each page of a dump"""
+
+    def __init__(self):
         super().__init__()
-        self.index_path = os.path.join(os.getcwd(), path_to_index)
-        self.stat_path = os.path.join(os.getcwd(), path_to_stat)
         self.title_start = 0
         self.id_start = 0
         self.id_done = 0
@@ -26,13 +81,6 @@ class WikiHandler(xml.sax.handler.ContentHandler):
         self.title = ""
         self.id = ""
         self.text = ""
-        self.global_data = {}
-        self.total_page_count = 0
-        self.file_count = 0
-        self.title_file_count = 0
-        self.titles = []
-        self.cur_file_size = 0
-        self.stage2_first_words = ""
 
     def startElement(self, tag, attributes):
         """Start tag reading"""
@@ -55,14 +103,10 @@ class WikiHandler(xml.sax.handler.ContentHandler):
             self.text += content
 
     def endElement(self, tag):
-        """End tag Reading and create Postings Doc for each document"""
+        """End tag Reading and hand over each page"""
         if tag == "page":
             self.page_start = 0
-            self.title = self.title.lower()
-            if not self.title.startswith(("wikipedia:", "file:", "category:", "template:", "portal:", "help:")):
-                self.total_page_count += 1
-                self.titles.append(self.title)
-                self.merge_dicts(process_data(ID=self.total_page_count, title=self.title, text=self.text))
+            self.end_page(self.title, self.id, self.text)
             self.title = ""
             self.id = ""
             self.text = ""
@@ -75,112 +119,508 @@ class WikiHandler(xml.sax.handler.ContentHandler):
         elif tag == "text":
             self.text_start = 0
 
-    def merge_dicts(self, doc_tokens: dict) -> None:
-        """Merge Postings Dict for the documents"""
-        for token, val in doc_tokens.items():
-
-            doc_list = list(doc_tokens[token].values())
-            doc_string = f"{doc_list[0]}-" + doc_list[1]
-            if len(doc_list[-1]):
-                doc_string += "-" + "".join(doc_list[-1])
-            self.cur_file_size += len(doc_string)
-            if token in self.global_data:
-                self.cur_file_size += 1
-                self.global_data[token] += " " + doc_string
+    def end_page(self, title: str, page_id: str, text: str) -> None:
+        """Handle a page read from the dump"""
+        raise NotImplementedError
+
+    def finish_pages(self) -> None:
+        """Process the pages left once the whole dump is read"""
+        raise NotImplementedError
+
+
+class ShardRouter(PageReader):
+    """Read a dump once for all the shards built in one pass, each page goes to the handlers of all the shards, which
+    keep the articles of their own shard"""
+
+    def __init__(self, handlers: list):
+        super().__init__()
+        self.handlers = handlers
+
+    def end_page(self, title: str, page_id: str, text: str) -> None:
+        for handler in self.handlers:
+            handler.end_page(title, page_id, text)
+
+    def finish_pages(self) -> None:
+        for handler in self.handlers:
+            handler.finish_pages()
+
+
+class WikiHandler(PageReader):
+    """Main Indexing Class"""
+
+    def __init__(self, path_to_index: str, path_to_stat: str, postings_format: str = "text", workers: int = 1,
+                 batch_size: int = 5000, field_postings: bool = False, merge_fan_in: int = 64,
+                 merge_workers: int = 1, memory_mb: float = 256, positions: bool = False, shard: int = 0,
+                 shard_count: int = 1, checkpoint_seconds: float = 0, tier_docs: int = 0, tier_count: int = 2,
+                 prune: bool = False, vocabulary: Vocabulary = VOCABULARY, record_page_ids: bool = False):
+        super().__init__()
+        self.tier_docs = tier_docs
+        self.tier_count = tier_count
+        self.prune = prune
+        self.checkpoint_seconds = checkpoint_seconds
+        self.last_checkpoint = timeit.default_timer()
+        self.page_count = 0
+        self.skip_pages = 0
+        self.stage2_runs = []
+        self.merge_pass = 0
+        self.last_word = ""
+        self.shard = shard
+        self.shard_count = shard_count
+        self.article_count = 0
+        self.memory_budget = memory_mb * (1 << 20)
+        self.merge_fan_in = merge_fan_in
+        self.merge_workers = merge_workers
+        self.postings_format = postings_format
+        self.field_postings = field_postings
+        self.workers = workers
+        self.batch_size = batch_size
+        self.pool = multiprocessing.Pool(workers) if workers > 1 else None
+        self.batch = []
+        self.pending = []
+        self.index_path = os.path.join(os.getcwd(), path_to_index)
+        self.stat_path = os.path.join(os.getcwd(), path_to_stat)
+        self.vocabulary = vocabulary
+        self.accumulator = PostingsAccumulator(vocabulary)
+        self.global_data = {}
+        self.total_page_count = 0
+        self.file_count = 0
+        self.title_file_count = 0
+        self.titles = []
+        self.page_ids = []
+        # wikipedia page ids of all the pages read, indexed or not, whose older versions a new segment replaces
+        self.read_page_ids = set() if record_page_ids else None
+        self.doc_lengths = array("I")
+        self.positions = [] if positions else None
+        self.cur_file_size = 0
+        self.stage2_first_words = ""
+        self.term_dict = None
+        self.field_dicts = {}
+        self.low_dict = None
+
+    def end_page(self, title: str, page_id: str, text: str) -> None:
+        """Create Postings Doc for each article of the shard"""
+        self.page_count += 1
+        if self.page_count <= self.skip_pages:
+            return
+        if self.read_page_ids is not None:
+            self.read_page_ids.add(page_id.strip())
+        title = title.lower()
+        is_article = not title.startswith(("wikipedia:", "file:", "category:", "template:", "portal:", "help:"))
+        self.article_count += is_article
+        if is_article and (self.article_count - 1) % self.shard_count == self.shard:
+            self.total_page_count += 1
+            INSTRUMENT.count("documents")
+            INSTRUMENT.tick()
+            self.titles.append(title)
+            self.page_ids.append(page_id.strip())
+            if self.pool is not None:
+                self.batch.append((self.total_page_count, title, text))
+                if len(self.batch) >= self.batch_size:
+                    self.submit_batch()
+                self.check_stage(stage=1, is_finish=False)
             else:
-                self.cur_file_size += len(token)
-                self.global_data[token] = doc_string
+                self.merge_dicts(process_data(ID=self.total_page_count, title=title, text=text,
+                                              positions=self.positions, vocabulary=self.vocabulary))
+        if self.checkpoint_seconds and timeit.default_timer() - self.last_checkpoint >= self.checkpoint_seconds:
+            self.checkpoint()
 
+    def merge_dicts(self, doc_tokens: dict) -> None:
+        """Merge Postings Dict for the documents"""
+        self.doc_lengths.append(doc_length(doc_tokens))
+        with INSTRUMENT.phase("merge_dicts"):
+            self.accumulator.add(doc_tokens)
         self.check_stage(stage=1, is_finish=False)
 
+    def submit_batch(self) -> None:
+        """Send the current batch of pages to the worker pool, its stage 1 index file number is fixed here so that
+        the stage 1 files stay in document order"""
+        self.file_count += 1
+        self.pending.append(self.pool.apply_async(process_batch, (self.index_path, self.file_count, self.batch,
+                                                                  self.positions is not None)))
+        self.batch = []
+        while len(self.pending) > 2 * self.workers:
+            self.collect_batch(self.pending.pop(0))
+
+    def collect_batch(self, result) -> None:
+        """Wait for a batch sent to the worker pool, batches are collected in order"""
+        lengths, encoded_terms, report = result.get()
+        self.doc_lengths.extend(lengths)
+        if self.positions is not None:
+            self.positions.extend(encoded_terms)
+        INSTRUMENT.merge(report)
+
+    def finish_batches(self) -> None:
+        """Process the remaining pages and wait for all the workers to finish"""
+        if self.pool is None:
+            return
+        if len(self.batch):
+            self.submit_batch()
+        for result in self.pending:
+            self.collect_batch(result)
+        self.pending = []
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+
+    def finish_pages(self) -> None:
+        """Process the remaining pages and write the last stage 1 index and titles files"""
+        self.finish_batches()
+        self.check_stage(stage=1, is_finish=True)
+
+    def checkpoint(self) -> None:
+        """Write the stage 1 index, titles, lengths and positions of all the pages read so far and record them in a
+        checkpoint, a resumed run skips these pages"""
+        with INSTRUMENT.phase("checkpoint"):
+            if self.pool is not None:
+                if len(self.batch):
+                    self.submit_batch()
+                for result in self.pending:
+                    self.collect_batch(result)
+                self.pending = []
+            self.check_stage(stage=1, is_finish=True)
+            self.save_checkpoint(stage=1)
+        self.last_checkpoint = timeit.default_timer()
+
+    def save_checkpoint(self, stage: int, **state) -> None:
+        """Atomically replace the checkpoint of the run, all the files it describes must already be written"""
+        INSTRUMENT.count("checkpoints")
+        checkpoint = {"stage": stage, "pages": self.page_count, "article_count": self.article_count,
+                      "total_page_count": self.total_page_count, "file_count": self.file_count,
+                      "title_file_count": self.title_file_count,
+                      "sizes": {name: os.path.getsize(os.path.join(self.index_path, name)) for name in APPENDED_FILES
+                                if os.path.exists(os.path.join(self.index_path, name))}}
+        checkpoint.update(state)
+        tmp_path = os.path.join(self.index_path, CHECKPOINT_FILE + ".tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, os.path.join(self.index_path, CHECKPOINT_FILE))
+
+    def save_merge_checkpoint(self, **state) -> None:
+        """Checkpoint stage 2 with the stage 1 index files left to merge, and the progress of the final merge"""
+        self.save_checkpoint(stage=2, runs=[os.path.basename(path) for path in self.stage2_runs],
+                             merge_pass=self.merge_pass, **state)
+
+    def restore(self, checkpoint: dict) -> None:
+        """Continue an interrupted run from its checkpoint: the files written after the checkpoint are dropped and,
+        during stage 1, the pages it covers are skipped"""
+        self.skip_pages = checkpoint["pages"]
+        self.page_count = 0
+        self.article_count = checkpoint["article_count"]
+        self.total_page_count = checkpoint["total_page_count"]
+        self.title_file_count = checkpoint["title_file_count"]
+        if checkpoint["stage"] == 2:
+            self.stage2_runs = [os.path.join(self.index_path, name) for name in checkpoint["runs"]]
+            self.merge_pass = checkpoint["merge_pass"]
+            return
+
+        self.file_count = checkpoint["file_count"]
+        self.drop_files(checkpoint["sizes"])
+
+    def drop_files(self, sizes: dict) -> None:
+        """Truncate the appended files to their given sizes and remove the runs and title files past the counts"""
+        for name in APPENDED_FILES:
+            path = os.path.join(self.index_path, name)
+            if name in sizes:
+                os.truncate(path, sizes[name])
+            elif os.path.exists(path):
+                os.remove(path)
+        for path in glob(os.path.join(self.index_path, 'index1_*.txt')):
+            run = RUN_REGEX.fullmatch(os.path.basename(path))
+            if run is not None and int(run.group(1)) > self.file_count:
+                os.remove(path)
+        # outputs of an interrupted merge, which starts over from the stage 1 index files
+        for path in glob(os.path.join(self.index_path, 'index1_pass*.txt')):
+            os.remove(path)
+        for path in glob(os.path.join(self.index_path, 'merge_part_*')):
+            shutil.rmtree(path)
+        for path in glob(os.path.join(self.index_path, 'title_*.txt')):
+            if int(Path(path).stem.split("_")[1]) > self.title_file_count:
+                os.remove(path)
+
     def index_creator(self, stage: int) -> None:
         """Write postings list to the files depending on the stage"""
-        sorted_global_data = sorted(self.global_data.items())
-        index_string = "\n".join([k + " " + v for k, v in sorted_global_data])
-        if stage == 2:
-            self.stage2_first_words += " " + sorted_global_data[0][0] if len(self.stage2_first_words) else \
-                sorted_global_data[0][0]
-
         self.file_count += 1
-        path_to_index = os.path.join(self.index_path, f'index{stage}_{self.file_count}.txt')
+        if stage == 1:
+            with INSTRUMENT.phase("write_run"):
+                self.accumulator.write_run(os.path.join(self.index_path, f'index1_{self.file_count}.txt'))
+            return
 
-        with open(path_to_index, 'w') as f:
-            f.write(index_string)
-
-    def title_index(self) -> None:
-        """Write titles files depending on the stage"""
-        title_string = "\n".join(self.titles)
+        sorted_global_data = sorted(self.global_data.items())
+        self.last_word = sorted_global_data[-1][0]
+        self.stage2_first_words += " " + sorted_global_data[0][0] if len(self.stage2_first_words) else \
+            sorted_global_data[0][0]
+        if self.postings_format == "binary" or self.field_postings or self.tier_docs:
+            self.decoded_index_creator(sorted_global_data)
+            return
+
+        offset = 0
+        for token, postings_list in sorted_global_data:
+            length = len(token) + 1 + len(postings_list)
+            max_count = max(int(doc.split("-", 1)[0]) for doc in postings_list.split(" "))
+            self.term_dict.add(token, self.file_count, offset, length, postings_list.count(" ") + 1, max_count)
+            offset += length + 1
 
-        self.title_file_count += 1
-        path_to_index = os.path.join(self.index_path, f'title_{self.title_file_count}.txt')
+        index_string = "\n".join([k + " " + v for k, v in sorted_global_data])
+        path_to_index = os.path.join(self.index_path, f'index2_{self.file_count}.txt')
 
         with open(path_to_index, 'w') as f:
-            f.write(title_string)
-
-    def check_stage(self, stage: int, is_finish: bool) -> None:
-        """Stage Dependent Writing"""
-        if (stage == 1 and self.cur_file_size >= 6e7 and not is_finish) or (
-                stage == 2 and self.cur_file_size >= 2e7 and not is_finish) or (is_finish and self.cur_file_size):
-            self.index_creator(stage=stage)
-            self.global_data = {}
-            self.cur_file_size = 0
-
-        if stage == 1 and ((len(self.titles) >= 1e4 and not is_finish) or (len(self.titles) and is_finish)):
-            self.title_index()
-            self.titles = []
+            f.write(index_string)
 
-    def merge_files(self):
-        """Merge stage 1 index files using heaps to create stage 2 index which is smaller, write all extra files
-        needed in searching """
-        stage1_file_count = self.file_count
-        left_files = stage1_file_count
-        self.file_count = 0
+    def decoded_index_creator(self, sorted_global_data: list) -> None:
+        """Write the stage 2 postings lists in the binary format, split in tiers or with postings lists per field"""
+        extension = POSTINGS_EXTENSION[self.postings_format]
+        path_to_index = os.path.join(self.index_path, f'index2_{self.file_count}.{extension}')
+        offset = 0
+        with open(path_to_index, 'wb') as f:
+            for token, postings_list in sorted_global_data:
+                docs, counts, masks = parse_text_postings(postings_list.split(" "))
+                if self.tier_docs and len(docs) >= self.tier_docs:
+                    offset = self.write_tiers(f, offset, token, docs, counts, masks)
+                else:
+                    offset = self.write_postings(f, offset, self.term_dict, token, docs, counts, masks)
+                if not self.field_postings:
+                    continue
+                for field in FIELDS:
+                    keep = [ind for ind, mask in enumerate(masks) if
+                            mask & FIELD_BITS[field] or (field == "b" and mask == 0)]
+                    if len(keep):
+                        offset = self.write_postings(f, offset, self.field_dicts[field], f"{token}:{field}",
+                                                     [docs[ind] for ind in keep], [counts[ind] for ind in keep],
+                                                     bytearray(masks[ind] for ind in keep))
+
+    def write_tiers(self, f, offset: int, token: str, docs: list, counts: list, masks: bytearray) -> int:
+        """Write the postings list of a frequent token as a top and a low impact tier, returns the offset after it"""
+        top = [ind for ind, count in enumerate(counts) if count >= self.tier_count]
+        low = [ind for ind, count in enumerate(counts) if count < self.tier_count]
+        if len(top) == 0 or len(low) == 0:
+            return self.write_postings(f, offset, self.term_dict, token, docs, counts, masks)
+
+        offset = self.write_postings(f, offset, self.term_dict, token, [docs[ind] for ind in top],
+                                     [counts[ind] for ind in top], bytearray(masks[ind] for ind in top))
+        if self.prune:
+            self.low_dict.add(token, self.file_count, offset, 0, len(low), max(counts[ind] for ind in low))
+            return offset
+        return self.write_postings(f, offset, self.low_dict, f"{token}:low", [docs[ind] for ind in low],
+                                   [counts[ind] for ind in low], bytearray(masks[ind] for ind in low))
+
+    def write_postings(self, f, offset: int, term_dict: TermDictWriter, token: str, docs: list, counts: list,
+                       masks: bytearray) -> int:
+        """Write one postings list and its term dictionary record, returns the offset after it"""
+        if self.postings_format == "binary":
+            postings_bytes = encode_postings(docs, counts, masks, skips=True)
+            length = len(postings_bytes)
+        else:
+            postings_bytes = (token + " " + " ".join(
+                [f"{count}-{doc}-{MASK_TAGS[mask]}" if mask else f"{count}-{doc}" for doc, count, mask in
+                 zip(docs, counts, masks)]) + "\n").encode()
+            length = len(postings_bytes) - 1
+        term_dict.add(token.split(":", 1)[0], self.file_count, offset, length, len(docs), max(counts))
+        f.write(postings_bytes)
+        return offset + len(postings_bytes)
+
+    def open_term_dicts(self, sizes: dict = None) -> None:
+        """Open new term dictionaries, or continue the dictionaries of a checkpoint from their checkpointed sizes"""
+        sizes = sizes or {}
+        self.term_dict = TermDictWriter(os.path.join(self.index_path, TERM_DICT_FILE), sizes.get(TERM_DICT_FILE))
+        if self.field_postings:
+            self.field_dicts = {field: TermDictWriter(os.path.join(self.index_path, field_dict_file(field)),
+                                                      sizes.get(field_dict_file(field))) for field in FIELDS}
+        if self.tier_docs:
+            self.low_dict = TermDictWriter(os.path.join(self.index_path, LOW_TIER_DICT_FILE),
+                                           sizes.get(LOW_TIER_DICT_FILE))
+
+    def merge_state(self) -> dict:
+        """Progress of the final merge after an index file is written: its last word, the first words and the sizes
+        of the term dictionaries"""
+        sizes = {TERM_DICT_FILE: self.term_dict.flush()}
+        for field, field_dict in self.field_dicts.items():
+            sizes[field_dict_file(field)] = field_dict.flush()
+        if self.low_dict is not None:
+            sizes[LOW_TIER_DICT_FILE] = self.low_dict.flush()
+        return {"file_count": self.file_count, "last_word": self.last_word, "first_words": self.stage2_first_words,
+                "dict_sizes": sizes}
+
+    def close_term_dicts(self) -> None:
+        self.term_dict.close()
+        for field_dict in self.field_dicts.values():
+            field_dict.close()
+        if self.low_dict is not None:
+            self.low_dict.close()
+
+    def merge_runs(self, run_paths: list, path_to_output: str = None, low: bytes = None, high: bytes = None) -> int:
+        """Heap merge of stage 1 index files restricted to the tokens in [low, high), written as the stage 2 index or
+        as a single stage 1 index file, returns the number of tokens"""
         heap = []
         files = {}
         words = {}
         total_word_count = 0
+        output = open(path_to_output, 'wb', buffering=IO_BUFFER) if path_to_output is not None else None
+
+        for i, path in enumerate(run_paths):
+            files[i] = open_run(path)
+            if low is not None:
+                seek_to_token(files[i], low)
+            words[i] = files[i].readline().rstrip(b"\n").split(b" ", 1)
+            if len(words[i][0]) == 0 or (high is not None and words[i][0] >= high):
+                files[i].close()
+            else:
+                heapq.heappush(heap, (words[i][0], i))
 
-        for i in range(1, stage1_file_count + 1):
-            file_name = os.path.join(self.index_path, f'index1_{i}.txt')
-            files[i] = open(file_name, 'r')
-            line = files[i].readline().rstrip()
-            words[i] = line.split(" ", 1)
-            heapq.heappush(heap, (words[i][0], i))
-
-        while left_files:
+        while len(heap):
             word = heap[0][0]
-
-            postings_list = ""
+            postings = []
             total_word_count += 1
 
             while len(heap) and word == heap[0][0]:
                 _, file = heapq.heappop(heap)
-                postings_list += " " + words[file][1] if len(postings_list) else words[file][1]
-                line = files[file].readline().rstrip()
-                if line == '':
+                postings.append(words[file][1])
+                words[file] = files[file].readline().rstrip(b"\n").split(b" ", 1)
+                if len(words[file][0]) == 0 or (high is not None and words[file][0] >= high):
                     files[file].close()
-                    left_files -= 1
                 else:
-                    words[file] = line.split(" ", 1)
                     heapq.heappush(heap, (words[file][0], file))
 
-            self.global_data[word] = postings_list
+            if output is not None:
+                output.write((b"\n" if total_word_count > 1 else b"") + word + b" " + b" ".join(postings))
+                continue
+
+            postings_list = b" ".join(postings).decode()
+            self.global_data[word.decode()] = postings_list
             self.cur_file_size += len(word) + len(postings_list)
 
             self.check_stage(stage=2, is_finish=False)
 
-        self.check_stage(stage=2, is_finish=True)
+        if output is not None:
+            output.close()
+        else:
+            self.check_stage(stage=2, is_finish=True)
+        return total_word_count
+
+    def reduce_runs(self, run_paths: list) -> list:
+        """Merge groups of consecutive stage 1 index files until at most merge_fan_in files are left, consecutive
+        groups keep the postings in doc id order"""
+        while len(run_paths) > self.merge_fan_in:
+            self.merge_pass += 1
+            merged_paths = []
+            for start in range(0, len(run_paths), self.merge_fan_in):
+                group = run_paths[start:start + self.merge_fan_in]
+                if len(group) == 1:
+                    merged_paths.append(group[0])
+                    continue
+                path_to_output = os.path.join(self.index_path,
+                                              f'index1_pass{self.merge_pass}_{len(merged_paths) + 1}.txt')
+                self.merge_runs(group, path_to_output=path_to_output)
+                merged_paths.append(path_to_output)
+                if self.checkpoint_seconds:
+                    self.stage2_runs = merged_paths + run_paths[start + self.merge_fan_in:]
+                    self.save_merge_checkpoint()
+                [os.remove(path) for path in group]
+            run_paths = merged_paths
+        return run_paths
+
+    def parallel_merge(self, run_paths: list) -> int:
+        """Split the token space into ranges merged by separate processes into their own directories, then number
+        their index files and join their term dictionaries and first words in range order"""
+        boundaries = sample_boundaries(run_paths, self.merge_workers)
+        ranges = list(zip([None] + boundaries, boundaries + [None]))
+        options = {"postings_format": self.postings_format, "field_postings": self.field_postings,
+                   "tier_docs": self.tier_docs, "tier_count": self.tier_count, "prune": self.prune}
+        part_paths = [os.path.join(self.index_path, f'merge_part_{part}') for part in range(len(ranges))]
+        with multiprocessing.Pool(len(ranges)) as pool:
+            results = pool.starmap(merge_range, [(part_path, run_paths, low, high, options) for part_path, (
+                low, high) in zip(part_paths, ranges)])
+
+        self.open_term_dicts()
+        total_word_count = 0
+        extension = POSTINGS_EXTENSION[self.postings_format]
+        for part_path, (file_count, first_words, word_count) in zip(part_paths, results):
+            for i in range(1, file_count + 1):
+                os.replace(os.path.join(part_path, f'index2_{i}.{extension}'),
+                           os.path.join(self.index_path, f'index2_{self.file_count + i}.{extension}'))
+            self.term_dict.extend(os.path.join(part_path, TERM_DICT_FILE), self.file_count)
+            for field, field_dict in self.field_dicts.items():
+                field_dict.extend(os.path.join(part_path, field_dict_file(field)), self.file_count)
+            if self.low_dict is not None:
+                self.low_dict.extend(os.path.join(part_path, LOW_TIER_DICT_FILE), self.file_count)
+            if len(first_words):
+                self.stage2_first_words += " " + first_words if len(self.stage2_first_words) else first_words
+            self.file_count += file_count
+            total_word_count += word_count
+            shutil.rmtree(part_path)
+        self.close_term_dicts()
+        return total_word_count
 
-        stage1_files = os.path.join(self.index_path, 'index1_*.txt')
-        [os.remove(f) for f in glob(stage1_files)]
+    def title_index(self) -> None:
+        """Write titles files depending on the stage"""
+        self.title_file_count += 1
+        write_titles(self.index_path, self.title_file_count, self.titles, self.page_ids)
 
-        output_dir = Path(self.index_path)
-        index_file_size = sum(f.stat().st_size for f in output_dir.glob('*') if f.is_file())
-        stat_string = f"Index size in GB: {index_file_size / 1e9}\nNumber of files in which the inverted index is " \
-                      f"split: {self.file_count + self.title_file_count + 2}\nNumber of tokens in the inverted " \
-                      f"index: {total_word_count} "
-        with open(self.stat_path, 'w') as f:
-            f.write(stat_string)
+        with open(os.path.join(self.index_path, PAGE_IDS_FILE), 'a') as f:
+            f.write("".join(f"{page_id}\n" for page_id in self.page_ids))
+
+    def check_stage(self, stage: int, is_finish: bool) -> None:
+        """Stage Dependent Writing"""
+        if stage == 1 and ((self.accumulator.memory >= self.memory_budget and not is_finish) or (
+                is_finish and len(self.accumulator))):
+            self.index_creator(stage=stage)
+            self.accumulator.reset()
+
+        if (stage == 2 and self.cur_file_size >= 2e7 and not is_finish) or (
+                stage == 2 and is_finish and self.cur_file_size):
+            with INSTRUMENT.phase("write_index"):
+                self.index_creator(stage=stage)
+            self.global_data = {}
+            self.cur_file_size = 0
+            if self.checkpoint_seconds:
+                self.save_merge_checkpoint(merge=self.merge_state())
+
+        if stage == 1 and ((len(self.titles) >= 1e4 and not is_finish) or (len(self.titles) and is_finish)):
+            with INSTRUMENT.phase("write_titles"):
+                self.title_index()
+            self.titles = []
+            self.page_ids = []
+
+        if stage == 1 and self.doc_lengths is not None and (len(self.doc_lengths) >= 1e4 or (
+                is_finish and len(self.doc_lengths))):
+            append_doc_lengths(self.index_path, self.doc_lengths)
+            self.doc_lengths = array("I")
+
+        if stage == 1 and self.positions is not None and (len(self.positions) >= 1e4 or (
+                is_finish and len(self.positions))):
+            append_positions(self.index_path, self.positions)
+            self.positions = []
+
+    def merge_files(self, checkpoint: dict = None):
+        """Merge stage 1 index files using heaps to create stage 2 index which is smaller, write all extra files
+        needed in searching, continuing from a stage 2 checkpoint if one is given"""
+        if checkpoint is None or checkpoint["stage"] == 1:
+            run_paths = [os.path.join(self.index_path, f'index1_{i}.txt') for i in range(1, self.file_count + 1)]
+            if INSTRUMENT.enabled:
+                INSTRUMENT.count("run_bytes", sum(os.path.getsize(path) for path in run_paths))
+            self.stage2_runs = run_paths
+            if self.checkpoint_seconds:
+                self.save_merge_checkpoint()
+        run_paths = self.reduce_runs(self.stage2_runs)
+        self.stage2_runs = run_paths
+        merge = checkpoint.get("merge") if checkpoint is not None else None
+        self.file_count = merge["file_count"] if merge is not None else 0
+        if merge is not None and checkpoint.get("done"):
+            self.stage2_first_words = merge["first_words"]
+            total_word_count = merge["dict_sizes"][TERM_DICT_FILE] // TERM_RECORD.size
+        elif self.merge_workers > 1 and len(run_paths):
+            total_word_count = self.parallel_merge(run_paths)
+        else:
+            low = None
+            if merge is not None:
+                self.stage2_first_words = merge["first_words"]
+                low = merge["last_word"].encode() + b"\0"
+            self.open_term_dicts(merge["dict_sizes"] if merge is not None else None)
+            total_word_count = self.merge_runs(run_paths, low=low)
+            if merge is not None:
+                total_word_count += merge["dict_sizes"][TERM_DICT_FILE] // TERM_RECORD.size
+            if self.checkpoint_seconds:
+                self.save_merge_checkpoint(merge=self.merge_state(), done=True)
+            self.close_term_dicts()
 
         file_count_path = os.path.join(self.index_path, 'page_count.txt')
         with open(file_count_path, 'w') as f:
@@ -190,25 +630,324 @@ class WikiHandler(xml.sax.handler.ContentHandler):
         with open(first_words_path, 'w') as f:
             f.write(self.stage2_first_words)
 
+        write_meta(self.index_path, {"postings": self.postings_format, "field_postings": self.field_postings,
+                                     "skips": self.postings_format == "binary",
+                                     "positions": self.positions is not None, "build_id": uuid.uuid4().hex,
+                                     "shard": self.shard, "shards": self.shard_count,
+                                     "tiers": {"docs": self.tier_docs, "count": self.tier_count, "pruned": self.prune}
+                                     if self.tier_docs else None})
+
+        stage1_files = os.path.join(self.index_path, 'index1_*.txt')
+        [os.remove(f) for f in glob(stage1_files)]
+        if os.path.exists(checkpoint_path := os.path.join(self.index_path, CHECKPOINT_FILE)):
+            os.remove(checkpoint_path)
+
+        output_files = [f for f in Path(self.index_path).glob('*') if f.is_file()]
+        index_file_size = sum(f.stat().st_size for f in output_files)
+        INSTRUMENT.count("index_bytes", index_file_size)
+        INSTRUMENT.count("tokens_indexed", total_word_count)
+        stat_string = f"Index size in GB: {index_file_size / 1e9}\nNumber of files in which the inverted index is " \
+                      f"split: {len(output_files)}\nNumber of tokens in the inverted index: {total_word_count} "
+        with open(self.stat_path, 'w') as f:
+            f.write(stat_string)
 
-def main():
-    if len(sys.argv) != 4:
-        print("Usage :: python3 indexer.py path_to_xml path_to_inverted_index index_name")
-        sys.exit(0)
 
-    path_to_wiki = sys.argv[1]
-    path_to_index = sys.argv[2]
-    path_to_stat = sys.argv[3]
+def write_segment_run(segment: IndexSegment, remap: list, path_to_run: str) -> bool:
+    """Write the live postings of a segment with remapped doc ids as a stage 1 index file, returns False and removes
+    the file if no postings are left"""
+    is_empty = True
+    with open(path_to_run, 'w') as f:
+        for token, doc_ids, counts, masks in segment.iter_postings():
+            postings_list = " ".join(
+                [f"{counts[ind]}-{remap[doc]}-{MASK_TAGS[masks[ind]]}" if masks[ind] else f"{counts[ind]}-{remap[doc]}"
+                 for ind, doc in enumerate(doc_ids) if remap[doc]])
+            if len(postings_list):
+                f.write(("" if is_empty else "\n") + token + " " + postings_list)
+                is_empty = False
+    if is_empty:
+        os.remove(path_to_run)
+    return not is_empty
+
+
+def merge_segment_group(index_path: str, manifest: dict, names: list, handler_options: dict) -> None:
+    """Merge segments into a new segment without their deleted documents. Each old segment is written as a stage 1
+    index file with renumbered doc ids and the files are combined by the usual stage 2 heap merge"""
+    name = f"seg_{manifest['next_segment']}"
+    manifest["next_segment"] += 1
+    segment_path = os.path.join(index_path, name)
+    os.makedirs(segment_path)
+    handler = WikiHandler(path_to_index=segment_path, path_to_stat=os.path.join(segment_path, 'stats.txt'),
+                          **handler_options)
+
+    old_segments = [IndexSegment(os.path.join(index_path, old_name)) for old_name in names]
+    if any(segment.doc_lengths is None for segment in old_segments):
+        handler.doc_lengths = None
+    handler.positions = [] if all(segment.positions is not None for segment in old_segments) else None
+    for segment in old_segments:
+        remap = [0] * (segment.doc_count + 1)
+        for doc, (title, page_id) in enumerate(zip(segment.titles(), segment.page_ids()), 1):
+            if doc in segment.deleted:
+                continue
+            handler.total_page_count += 1
+            remap[doc] = handler.total_page_count
+            handler.titles.append(title)
+            handler.page_ids.append(page_id)
+            if handler.doc_lengths is not None:
+                handler.doc_lengths.append(segment.doc_lengths[doc - 1])
+            if handler.positions is not None:
+                handler.positions.append(segment.positions.encoded(doc))
+            handler.check_stage(stage=1, is_finish=False)
+        if write_segment_run(segment, remap, os.path.join(segment_path, f'index1_{handler.file_count + 1}.txt')):
+            handler.file_count += 1
+    handler.check_stage(stage=1, is_finish=True)
+
+    position = min(ind for ind, segment in enumerate(manifest["segments"]) if segment["name"] in names)
+    segments = [segment for segment in manifest["segments"] if segment["name"] not in names]
+    if handler.total_page_count:
+        handler.merge_files()
+        segments.insert(position, {"name": name, "docs": handler.total_page_count})
+    else:
+        shutil.rmtree(segment_path)
+    manifest["segments"] = segments
+    write_manifest(index_path, manifest)
+    for old_name in names:
+        shutil.rmtree(os.path.join(index_path, old_name))
+
+
+def merge_segments(index_path: str, merge_factor: int, max_segments: int, handler_options: dict) -> None:
+    """Compact the segments of an index according to the merge policy, searches keep using the old segments until
+    the new segment list is committed"""
+    with manifest_lock(index_path):
+        manifest = read_manifest(index_path)
+        while len(names := select_merge(index_path, manifest, merge_factor, max_segments)):
+            merge_segment_group(index_path, manifest, names, handler_options)
+
+
+def parse_args() -> argparse.Namespace:
+    arg_parser = argparse.ArgumentParser(usage="python3 indexer.py path_to_xml path_to_inverted_index index_name "
+                                               "[options]")
+    arg_parser.add_argument("path_to_wiki")
+    arg_parser.add_argument("path_to_index")
+    arg_parser.add_argument("path_to_stat")
+    arg_parser.add_argument("--postings", choices=list(POSTINGS_EXTENSION), default="text",
+                            help="encoding of the stage 2 postings lists")
+    arg_parser.add_argument("--field-postings", action="store_true",
+                            help="also store a postings list per field for each token")
+    arg_parser.add_argument("--positions", action="store_true",
+                            help="also store the stemmed terms of each document in order, used to match phrases")
+    arg_parser.add_argument("--workers", type=int, default=1,
+                            help="number of processes used for processing the documents")
+    arg_parser.add_argument("--batch-size", type=int, default=5000,
+                            help="number of pages sent to a worker process at a time")
+    arg_parser.add_argument("--memory-mb", type=float, default=256,
+                            help="memory budget of the stage 1 postings lists, a stage 1 index file is written when "
+                                 "they exceed it")
+    arg_parser.add_argument("--merge-fan-in", type=int, default=64,
+                            help="largest number of stage 1 index files merged at once")
+    arg_parser.add_argument("--merge-workers", type=int, default=1,
+                            help="number of processes merging separate token ranges of the stage 1 index files")
+    arg_parser.add_argument("--dump-index", default=None,
+                            help="index of a bz2 multistream dump, defaults to the -index.txt.bz2 file next to it")
+    arg_parser.add_argument("--decompress-workers", type=int, default=os.cpu_count(),
+                            help="number of processes decompressing the streams of a bz2 dump")
+    arg_parser.add_argument("--segment", action="store_true",
+                            help="add the dump to the index as a new segment, replacing older versions of its pages")
+    arg_parser.add_argument("--delete-pages", default=None,
+                            help="file of wikipedia page ids, one per line, to delete from a segmented index")
+    arg_parser.add_argument("--merge-factor", type=int, default=4, help="number of segments merged at a time")
+    arg_parser.add_argument("--max-segments", type=int, default=8,
+                            help="number of segments above which segments are merged")
+    arg_parser.add_argument("--shards", type=int, default=1,
+                            help="split the articles in turn over this many shards, written to the shard_N "
+                                 "directories of the index, each a complete index of its articles")
+    arg_parser.add_argument("--shard", type=int, default=None,
+                            help="only write this shard, so that the shards can be indexed on separate machines")
+    arg_parser.add_argument("--tier-docs", type=int, default=0,
+                            help="split the postings lists of the tokens found in at least this many documents into a "
+                                 "top and a low impact tier, 0 disables the tiers")
+    arg_parser.add_argument("--tier-count", type=int, default=2,
+                            help="smallest weighted count of a document in the top tier of a token")
+    arg_parser.add_argument("--prune", action="store_true",
+                            help="drop the low tiers from the index, only their document frequencies are kept")
+    arg_parser.add_argument("--checkpoint-seconds", type=float, default=0,
+                            help="interval between checkpoints of the progress of the run, 0 (the default) disables "
+                                 "them")
+    arg_parser.add_argument("--resume", action="store_true",
+                            help="continue the interrupted run of the index from its last checkpoint")
+    arg_parser.add_argument("--instrument", default=None,
+                            help="time the indexing phases, count the work done and write a JSON report to this file")
+    arg_parser.add_argument("--progress-seconds", type=float, default=10,
+                            help="interval of the progress printed while instrumenting, 0 disables it")
+    arg_parser.add_argument("--profile", default=None,
+                            help="phase run under cProfile while instrumenting, such as parse, process_data or "
+                                 "merge_files")
+    args = arg_parser.parse_args()
+    if args.shards > 1 and args.segment:
+        arg_parser.error("--segment cannot be combined with --shards")
+    if args.prune and not args.tier_docs:
+        arg_parser.error("--prune drops the low tiers, give --tier-docs")
+    if args.prune and args.segment:
+        arg_parser.error("--prune cannot be combined with --segment, merged segments would lose the pruned documents")
+    if args.resume and args.segment:
+        arg_parser.error("--resume cannot be combined with --segment, an interrupted segment is never committed")
+    if args.delete_pages is not None and not args.segment:
+        arg_parser.error("--delete-pages tombstones pages of a segmented index, give --segment")
+    if not args.segment and read_manifest(args.path_to_index) is not None:
+        arg_parser.error(f"{args.path_to_index} is a segmented index, add the dump to it with --segment")
+    if args.shard is not None and not 0 <= args.shard < args.shards:
+        arg_parser.error("--shard must be a shard number below --shards")
+    return args
+
+
+def add_segment(args: argparse.Namespace) -> None:
+    """Index the dump as a new segment, tombstone the replaced and deleted pages in the older segments, commit the
+    new segment list and then merge segments according to the merge policy"""
+    os.makedirs(args.path_to_index, exist_ok=True)
+    with manifest_lock(args.path_to_index):
+        manifest = read_manifest(args.path_to_index)
+        if manifest is None:
+            manifest = {"generation": 0, "next_segment": 1, "segments": []}
+        name = f"seg_{manifest['next_segment']}"
+        manifest["next_segment"] += 1
+        segment_path = os.path.join(args.path_to_index, name)
+        os.makedirs(segment_path)
+        handler = build_index(args, segment_path)
+
+        page_ids = handler.read_page_ids
+        if args.delete_pages is not None:
+            with open(args.delete_pages, 'r') as f:
+                page_ids |= {line.strip() for line in f if line.strip()}
+        print("Deleted documents: ", delete_pages(args.path_to_index, manifest, page_ids))
+
+        if handler.total_page_count:
+            manifest["segments"].append({"name": name, "docs": handler.total_page_count})
+        else:
+            shutil.rmtree(segment_path)
+        write_manifest(args.path_to_index, manifest)
+
+    merge_segments(args.path_to_index, args.merge_factor, args.max_segments,
+                   {"postings_format": args.postings, "field_postings": args.field_postings,
+                    "merge_fan_in": args.merge_fan_in, "merge_workers": args.merge_workers,
+                    "tier_docs": args.tier_docs, "tier_count": args.tier_count})
+
+
+def parse_dump(handler: PageReader, path_to_wiki: str, dump_index: str = None, decompress_workers: int = 1) -> None:
+    """Run the SAX parser over a dump and write the last stage 1 index and titles files, the streams of a bz2
+    multistream dump are decompressed in parallel"""
     parser = xml.sax.make_parser()
-    handler = WikiHandler(path_to_index=path_to_index, path_to_stat=path_to_stat)
     parser.setContentHandler(handler)
-    parser.parse(path_to_wiki)
-    handler.check_stage(stage=1, is_finish=True)
+    with INSTRUMENT.phase("parse"):
+        if path_to_wiki.endswith(".bz2"):
+            dump_index = dump_index if dump_index is not None else default_index_path(path_to_wiki)
+            for data in read_multistream(path_to_wiki, index_path=dump_index, workers=decompress_workers):
+                parser.feed(data)
+            parser.close()
+        else:
+            parser.parse(path_to_wiki)
+        handler.finish_pages()
+
+
+def build_path(path_to_index: str) -> str:
+    """Directory next to an index in which it is rebuilt, so that the old index can be searched until it is replaced"""
+    path = os.path.abspath(path_to_index)
+    return os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.building")
+
+
+def replace_index(path_to_build: str, path_to_index: str) -> None:
+    """Swap a finished build in for the index, searches keep the files of the old index they opened until they see
+    the metadata of the new one"""
+    path = os.path.abspath(path_to_index)
+    old_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.old")
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, old_path)
+    os.rename(path_to_build, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def open_handler(args: argparse.Namespace, path_to_index: str, path_to_stat: str = None, shard: int = 0,
+                 memory_mb: float = None, workers: int = None, vocabulary: Vocabulary = VOCABULARY) -> tuple:
+    """Handler of the index, built in its build directory unless it is a new segment, and the checkpoint of its
+    interrupted run, which the handler continues, or None"""
+    path_to_build = path_to_index if args.segment else build_path(path_to_index)
+    checkpoint = read_checkpoint(path_to_build)
+    if checkpoint is not None and not args.resume:
+        raise SystemExit(f"{path_to_build} holds an interrupted run of {path_to_index}, continue it with --resume or "
+                         f"remove it")
+    if checkpoint is None and not args.segment:
+        shutil.rmtree(path_to_build, ignore_errors=True)
+        os.makedirs(path_to_build)
+    handler = WikiHandler(path_to_index=path_to_build, path_to_stat=path_to_stat or args.path_to_stat,
+                          postings_format=args.postings, workers=workers or args.workers, batch_size=args.batch_size,
+                          field_postings=args.field_postings, merge_fan_in=args.merge_fan_in,
+                          merge_workers=args.merge_workers, memory_mb=memory_mb or args.memory_mb,
+                          positions=args.positions, shard=shard, shard_count=args.shards,
+                          checkpoint_seconds=0 if args.segment else args.checkpoint_seconds,
+                          tier_docs=args.tier_docs, tier_count=args.tier_count, prune=args.prune,
+                          vocabulary=vocabulary, record_page_ids=args.segment)
+    if checkpoint is not None:
+        print(f"Resuming from the stage {checkpoint['stage']} checkpoint after {checkpoint['pages']} pages")
+        handler.restore(checkpoint)
+    return handler, checkpoint
+
+
+def finish_index(handler: WikiHandler, checkpoint: dict = None) -> WikiHandler:
+    """Merge the stage 1 index files of a parsed dump into the stage 2 index"""
     start1 = timeit.default_timer()
-    handler.merge_files()
+    with INSTRUMENT.phase("merge_files"):
+        handler.merge_files(checkpoint if checkpoint is not None and checkpoint["stage"] == 2 else None)
     stop1 = timeit.default_timer()
     print(stop1 - start1)
     print("Memory taken: ", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (10 ** 6), " GB")
+    return handler
+
+
+def build_index(args: argparse.Namespace, path_to_index: str, path_to_stat: str = None, shard: int = 0) -> WikiHandler:
+    """Index the dump, or continue the interrupted run of the index from its checkpoint"""
+    handler, checkpoint = open_handler(args, path_to_index, path_to_stat=path_to_stat, shard=shard)
+    if checkpoint is None or checkpoint["stage"] == 1:
+        parse_dump(handler, args.path_to_wiki, dump_index=args.dump_index, decompress_workers=args.decompress_workers)
+    finish_index(handler, checkpoint)
+    if not args.segment:
+        replace_index(handler.index_path, path_to_index)
+    return handler
+
+
+def build_shards(args: argparse.Namespace) -> None:
+    """Index all the shards in a single pass over the dump, or only the shard given"""
+    stat_root, stat_ext = os.path.splitext(args.path_to_stat)
+    opened = []
+    for shard in range(args.shards) if args.shard is None else [args.shard]:
+        shard_path = os.path.join(args.path_to_index, f"shard_{shard}")
+        if args.shard is not None:
+            build_index(args, shard_path, path_to_stat=f"{stat_root}_shard_{shard}{stat_ext}", shard=shard)
+            return
+        opened.append((shard_path,) + open_handler(
+            args, shard_path, path_to_stat=f"{stat_root}_shard_{shard}{stat_ext}", shard=shard,
+            memory_mb=args.memory_mb / args.shards, workers=max(1, args.workers // args.shards),
+            vocabulary=Vocabulary()))
+    parsing = [handler for _, handler, checkpoint in opened if checkpoint is None or checkpoint["stage"] == 1]
+    if len(parsing):
+        parse_dump(ShardRouter(parsing), args.path_to_wiki, dump_index=args.dump_index,
+                   decompress_workers=args.decompress_workers)
+    for _, handler, checkpoint in opened:
+        finish_index(handler, checkpoint)
+    for shard_path, handler, _ in opened:
+        replace_index(handler.index_path, shard_path)
+
+
+def main():
+    args = parse_args()
+    if args.instrument is not None:
+        INSTRUMENT.enable(progress_seconds=args.progress_seconds, profile_phase=args.profile)
+    if args.segment:
+        add_segment(args)
+    elif args.shards > 1:
+        build_shards(args)
+    else:
+        build_index(args, args.path_to_index)
+    if args.instrument is not None:
+        INSTRUMENT.write_report(args.instrument)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,117 @@
+from contextlib import contextmanager, nullcontext
+import cProfile
+import json
+import sys
+import timeit
+
+NULL_PHASE = nullcontext()
+
+
+class Instrument:
+    """Timers of the nested phases and counters of the work done while indexing or searching. It is disabled by
+    default, in which case each call returns at once, and a phase can be profiled with cProfile"""
+
+    def __init__(self):
+        self.enabled = False
+        self.progress_seconds = 0
+        self.profile_phase = None
+        self.profiler = None
+        self.profile_depth = 0
+        self.stack = []
+        self.timers = {}
+        self.counters = {}
+        self.start = timeit.default_timer()
+        self.last_progress = self.start
+
+    def enable(self, progress_seconds: float = 0, profile_phase: str = None) -> None:
+        """Start recording, printing the counters every progress_seconds if it is set and running the given phase
+        under cProfile"""
+        self.enabled = True
+        self.progress_seconds = progress_seconds
+        self.profile_phase = profile_phase
+        self.profiler = cProfile.Profile() if profile_phase is not None else None
+        self.start = timeit.default_timer()
+        self.last_progress = self.start
+
+    def phase(self, name: str):
+        """Context manager timing a phase, the time of the phases nested in it is also reported separately"""
+        return self.timed(name) if self.enabled else NULL_PHASE
+
+    @contextmanager
+    def timed(self, name: str):
+        is_profiled = name == self.profile_phase and self.profile_depth == 0
+        if name == self.profile_phase:
+            self.profile_depth += 1
+        if is_profiled:
+            self.profiler.enable()
+        self.stack.append(0.0)
+        start = timeit.default_timer()
+        try:
+            yield
+        finally:
+            elapsed = timeit.default_timer() - start
+            nested = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += elapsed
+            timer = self.timers.setdefault(name, [0.0, 0.0, 0])
+            timer[0] += elapsed
+            timer[1] += elapsed - nested
+            timer[2] += 1
+            if name == self.profile_phase:
+                self.profile_depth -= 1
+            if is_profiled:
+                self.profiler.disable()
+
+    def count(self, name: str, value: int = 1) -> None:
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def tick(self) -> None:
+        """Print the counters and their rates if progress_seconds passed since they were last printed"""
+        if not self.enabled or not self.progress_seconds:
+            return
+        now = timeit.default_timer()
+        if now - self.last_progress < self.progress_seconds:
+            return
+        self.last_progress = now
+        elapsed = now - self.start
+        progress = " ".join(f"{name}={value} ({value / elapsed:.0f}/s)" for name, value in self.counters.items())
+        print(f"[{elapsed:.1f}s] {progress}", file=sys.stderr)
+
+    def report(self) -> dict:
+        return {"seconds": timeit.default_timer() - self.start,
+                "phases": {name: {"seconds": total, "self_seconds": own, "calls": calls}
+                           for name, (total, own, calls) in self.timers.items()},
+                "counters": dict(self.counters)}
+
+    def take(self) -> dict:
+        """Report of the phases and counters recorded since the last take, used to send the work of a worker
+        process to the main process"""
+        report = self.report()
+        self.timers = {}
+        self.counters = {}
+        return report
+
+    def merge(self, report: dict) -> None:
+        """Add the phases and counters of a report taken in another process"""
+        if not self.enabled or report is None:
+            return
+        for name, phase in report["phases"].items():
+            timer = self.timers.setdefault(name, [0.0, 0.0, 0])
+            timer[0] += phase["seconds"]
+            timer[1] += phase["self_seconds"]
+            timer[2] += phase["calls"]
+        for name, value in report["counters"].items():
+            self.count(name, value)
+
+    def write_report(self, path: str) -> None:
+        """Write the JSON report, and the profile of the profiled phase next to it"""
+        report = self.report()
+        if self.profiler is not None:
+            report["profile"] = f"{path}.{self.profile_phase}.prof"
+            self.profiler.dump_stats(report["profile"])
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+INSTRUMENT = Instrument()
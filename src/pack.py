@@ -0,0 +1,36 @@
+#!/usr/bin/python
+import argparse
+import os
+import timeit
+
+from index_format import IndexPack, write_pack
+from segments import read_manifest
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(usage="python3 pack.py path_to_inverted_index [path_to_pack] | "
+                                               "python3 pack.py path_to_pack")
+    arg_parser.add_argument("path_to_index", help="index directory to pack, or a pack to verify")
+    arg_parser.add_argument("path_to_pack", nargs="?", default=None,
+                            help="pack file to write, the index directory with a .pack extension by default")
+    args = arg_parser.parse_args()
+
+    start = timeit.default_timer()
+    if os.path.isfile(args.path_to_index):
+        pack = IndexPack(args.path_to_index)
+        corrupt = pack.verify()
+        print(f"{len(pack.sections)} sections, {pack.manifest['doc_count']} documents, "
+              f"{pack.manifest['term_count']} terms")
+        print(f"Corrupt sections: {', '.join(corrupt)}" if corrupt else "All checksums match")
+    else:
+        if read_manifest(args.path_to_index) is not None:
+            raise SystemExit(f"{args.path_to_index} is a segmented index, pack each segment or merge them first")
+        path_to_pack = args.path_to_pack or args.path_to_index.rstrip("/") + ".pack"
+        manifest = write_pack(args.path_to_index, path_to_pack)
+        print(f"Packed {len(manifest['sections'])} files into {path_to_pack} "
+              f"({os.path.getsize(path_to_pack) / 1e9:.6f} GB)")
+    print(timeit.default_timer() - start)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,42 +1,29 @@
 from collections import defaultdict
 import re
-import Stemmer
 
-from stopwords import STOPWORDS
+from index_format import encode_positions
+from instrument import INSTRUMENT
+from vocabulary import Vocabulary
 
-STEMMER = Stemmer.Stemmer('english')
-LINK_REGEX = re.compile(r"==External links==.*\n(.+\n)*?[^\n]*(?=\n\n|\[\[Category)")
+VOCABULARY = Vocabulary()
+LINK_REGEX = re.compile(r"==External links==.*\n(.+\n)*?[^\n]*(?=\n\n)")
 INFOBOX_REGEX = re.compile(r"{{Infobox")
 HTML_REGEX = re.compile(r"<[^>]*>")
-SELF_CLOSING = re.compile(r"<[^>]*/>")
-BACK_REGEX = re.compile(r"\n\n")
 CLOSE_CURLY_REGEX = re.compile(r"\n}}|\n }}|\n==")
 REFERENCE_REGEX = re.compile(r"==References==.*\n(.+\n)*?[^\n]*(?=(\n\n|\n==))")
 REF_BEGIN_END_REGEX = re.compile(r"{{refbegin}}\n(.+\n)*?(?={{refend}})")
-REF_REGEX = re.compile(r"<ref[^>]*>[^<]*</ref>")
-CATEGORY_REGEX = re.compile(r"\[\[Category:[^]]*]]")
+# self closing tags, ref tags and categories, the lookbehinds pick the alternatives for the character matched first
+INLINE_REGEX = re.compile(r"[<\[](?:(?<=<)(?P<self_closing>[^>]*/>)|(?<=<)(?P<ref>ref[^>]*>(?:[^<]|<[^>]*/>)*</ref>)"
+                          r"|(?<=\[)(?P<category>\[Category:[^]]*]]))")
 URL_REGEX = re.compile(r"http[^ }|]*[ }|]|[a-z0-9]*\.(svg|png|jpeg|jpg|com|html|gif|pdf)")
 EQUALITY_REGEX = re.compile(r"(\||!) ?[^=|\n}\]]*=")
-GARBAGE_REGEX = re.compile(r"\d+[a-z]+\d|[a-z]+\d+[a-z]|([a-z])\1{2,}")
 SPLIT_REGEX = re.compile(r"[^a-z0-9]+")
+MARKUP = (("inline", INLINE_REGEX), ("references", REFERENCE_REGEX), ("refbegin", REF_BEGIN_END_REGEX),
+          ("links", LINK_REGEX), ("infobox", INFOBOX_REGEX))
 DOC_ID = ""
 PASSAGE_WEIGHTS = {"t": 6, "i": 3, "c": 2, "r": 1, "l": 1, "b": 1}
 
 
-def remove_stopwords(text: list) -> list:
-    """Stopwords Removal"""
-    reduced_words = [word for word in text if word not in STOPWORDS]
-    return reduced_words
-
-
-def stemming(text: list) -> list:
-    """Stemming and Cleaning of Stemmed Tokens"""
-    stemmed_words = STEMMER.stemWords(text)
-    stemmed_words_filtered = [word for word in stemmed_words if word[0:2] != "00" and len(word) <= 20 and (
-            (not word.isdigit() and not GARBAGE_REGEX.match(word)) or (len(word) <= 4 and word.isdigit()))]
-    return stemmed_words_filtered
-
-
 def tokenize(text: str) -> list:
     """Tokenization of the text"""
     text = HTML_REGEX.sub(r" ", text)
@@ -59,101 +46,136 @@ def token_dict(tokens: list, pos: str, doc_dict: dict) -> dict:
     return doc_dict
 
 
-def parse_string(text: str) -> list:
-    """Processing Text and then tokenizing"""
-    text = text.lower()
-    tokenized_text = tokenize(text)
-    tokenized_text = remove_stopwords(tokenized_text)
-    tokenized_text = stemming(tokenized_text)
-    return tokenized_text
+def doc_length(doc_dict: dict) -> int:
+    """Length of a document, the sum of the weighted counts of its terms"""
+    return sum(val["count"] for val in doc_dict.values())
 
 
-def parse_title(text: str, doc_dict: dict) -> dict:
-    tokens = parse_string(text)
-    doc_dict = token_dict(tokens, "t", doc_dict)
-    return doc_dict
+def parse_string(text: str, vocabulary: Vocabulary = VOCABULARY) -> list:
+    """Processing Text and then tokenizing into term ids"""
+    text = text.lower()
+    return vocabulary.lookup(tokenize(text))
 
 
-def extract_body(text: str, doc_dict: dict) -> dict:
-    tokens = parse_string(text)
-    doc_dict = token_dict(tokens, "b", doc_dict)
+def parse_title(text: str, doc_dict: dict, vocabulary: Vocabulary = VOCABULARY) -> dict:
+    tokens = parse_string(text, vocabulary)
+    doc_dict = token_dict(tokens, "t", doc_dict)
     return doc_dict
 
 
-def extract_links(text: str, doc_dict: dict) -> tuple:
-    """Extract External Links"""
-    match = LINK_REGEX.search(text)
-    if match:
-        tokens = parse_string(text[match.start():match.end()])
-        doc_dict = token_dict(tokens, "l", doc_dict)
-        text = LINK_REGEX.sub(" ", text)
-
-    return text, doc_dict
-
-
-def extract_infobox(text: str, doc_dict: dict) -> tuple:
-    """Extract Infobox"""
-    new_text = text
-    start_ind = -1
+def cut_spans(text: str, start: int, end: int, spans: list) -> str:
+    """Text between start and end with each of the sorted spans inside it replaced by a space"""
+    pieces = []
+    for span_start, span_end in spans:
+        pieces.append(text[start:span_start])
+        start = span_end
+    pieces.append(text[start:end])
+    return " ".join(pieces)
+
+
+def markup_matches(text: str, markup: tuple, start: int = 0, end: int = None):
+    """Leftmost non overlapping (kind, match) of the markup between start and end, the kind listed first wins ties"""
+    end = len(text) if end is None else end
+    found = [regex.search(text, start, end) for _, regex in markup]
+    pos = start
+    while True:
+        best = -1
+        for ind, match in enumerate(found):
+            if match is not None and match.start() < pos:
+                match = found[ind] = markup[ind][1].search(text, pos, end)
+            if match is not None and (best == -1 or match.start() < found[best].start()):
+                best = ind
+        if best == -1:
+            return
+        pos = found[best].end()
+        yield found[best].lastgroup or markup[best][0], found[best]
+
+
+def segment_section(text: str, kind: str, start: int, end: int, spans: list, seen: set) -> str:
+    """Extract the markup nested in a references, refbegin or external links section and return the rest of it"""
+    nested = []
+    markup, search_end = MARKUP[:1], end
+    if kind == "links":
+        # the sections nested in a links section end at the blank line after it, which their regexes look ahead to
+        markup, search_end = MARKUP[:3], end + 2
+    for markup_kind, match in markup_matches(text, markup, start, search_end):
+        if markup_kind == "ref":
+            spans.append(("r", match.group()))
+        elif markup_kind == "category":
+            # a category is reference text in a references section but not in a links section
+            if kind != "links":
+                continue
+            spans.append(("c", match.group()))
+        elif markup_kind != "self_closing":
+            section_text = segment_section(text, markup_kind, *match.span(), spans, seen)
+            if markup_kind not in seen:
+                seen.add(markup_kind)
+                spans.append(("r", section_text))
+        nested.append(match.span())
+    return cut_spans(text, start, end, nested)
+
+
+def segment_text(text: str) -> list:
+    """Split the wiki markup of a page into (field tag, text) spans in a single pass, the body is the last span"""
+    spans = []
+    removed = []
+    infoboxes = []
+    seen = set()
+    shift = 0
+    for kind, match in markup_matches(text, MARKUP):
+        start, end = match.span()
+        if kind == "ref":
+            spans.append(("r", match.group()))
+        elif kind == "category":
+            spans.append(("c", match.group()))
+        elif kind == "infobox":
+            infoboxes.append((start - shift, end - shift))
+            continue
+        elif kind != "self_closing":
+            section_text = segment_section(text, kind, start, end, spans, seen)
+            if kind not in seen:
+                seen.add(kind)
+                spans.append(("l" if kind == "links" else "r", section_text))
+        removed.append((start, end))
+        shift += end - start - 1
+
+    text = cut_spans(text, 0, len(text), removed)
     end_ind = -1
-    for match in INFOBOX_REGEX.finditer(text):
-        start_ind = min(match.start(), start_ind) if start_ind != -1 else match.start()
-        infobox_text = text[match.end():]
-        close_match = CLOSE_CURLY_REGEX.search(infobox_text)
+    for _, content_start in infoboxes:
+        close_match = CLOSE_CURLY_REGEX.search(text, content_start)
         if close_match:
-            tokens = parse_string(infobox_text[:close_match.start()])
-            doc_dict = token_dict(tokens, "i", doc_dict)
-            end_ind = max(end_ind, close_match.end())
-
-    if start_ind != -1 and end_ind != -1:
-        new_text = text[:start_ind] + " " + text[end_ind:]
-
-    return new_text, doc_dict
-
-
-def extract_categories(text: str, doc_dict: dict) -> tuple:
-    """Extract Categories"""
-    for match in CATEGORY_REGEX.finditer(text):
-        tokens = parse_string(text[match.start():match.end()])
-        doc_dict = token_dict(tokens, "c", doc_dict)
-
-    text = CATEGORY_REGEX.sub(" ", text)
-    return text, doc_dict
-
-
-def extract_references(text: str, doc_dict: dict) -> tuple:
-    """Extract References"""
-    for match in REF_REGEX.finditer(text):
-        tokens = parse_string(text[match.start():match.end()])
-        doc_dict = token_dict(tokens, "r", doc_dict)
-
-    text = REF_REGEX.sub(" ", text)
-
-    match = REFERENCE_REGEX.search(text)
-    if match:
-        tokens = parse_string(text[match.start():match.end()])
-        doc_dict = token_dict(tokens, "r", doc_dict)
-        text = REFERENCE_REGEX.sub(" ", text)
-
-    match = REF_BEGIN_END_REGEX.search(text)
-    if match:
-        tokens = parse_string(text[match.start():match.end()])
-        doc_dict = token_dict(tokens, "r", doc_dict)
-        text = REF_BEGIN_END_REGEX.sub(" ", text)
+            spans.append(("i", text[content_start:close_match.start()]))
+            # the cut off is relative to the infobox content, as it has always been indexed
+            end_ind = max(end_ind, close_match.end() - content_start)
+    if end_ind != -1:
+        text = text[:infoboxes[0][0]] + " " + text[end_ind:]
 
-    return text, doc_dict
+    spans.append(("b", text))
+    return spans
 
 
-def process_data(ID: int, title: str, text: str) -> dict:
-    """Processing Document text and finding individual Parts of the Text"""
+def process_data(ID: int, title: str, text: str, positions: list = None, vocabulary: Vocabulary = VOCABULARY) -> dict:
+    """Processing Document text and finding individual Parts of the Text, the postings dict is keyed by the term ids
+    of the vocabulary. If a positions list is given the encoded terms of each field are appended to it"""
     global DOC_ID
     DOC_ID = str(ID)
-    doc_dict = {}
-    text = SELF_CLOSING.sub(" ", text)
-    doc_dict = parse_title(title, doc_dict)
-    text, doc_dict = extract_references(text, doc_dict)
-    text, doc_dict = extract_categories(text, doc_dict)
-    text, doc_dict = extract_links(text, doc_dict)
-    text, doc_dict = extract_infobox(text, doc_dict)
-    doc_dict = extract_body(text, doc_dict)
+    with INSTRUMENT.phase("process_data"):
+        doc_dict = {}
+        doc_dict = parse_title(title, doc_dict, vocabulary)
+        with INSTRUMENT.phase("segment"):
+            spans = segment_text(text)
+        field_tokens = {}
+        with INSTRUMENT.phase("tokenize"):
+            for pos, span in spans:
+                field_tokens.setdefault(pos, []).extend(tokenize(span.lower()))
+        with INSTRUMENT.phase("stem"):
+            field_terms = {pos: vocabulary.lookup(tokens) for pos, tokens in field_tokens.items()}
+        with INSTRUMENT.phase("token_dict"):
+            for pos, terms in field_terms.items():
+                doc_dict = token_dict(terms, pos, doc_dict)
+                INSTRUMENT.count("tokens", len(terms))
+        if positions is not None:
+            fields = [parse_string(title, vocabulary)] + list(field_terms.values())
+            positions.append(encode_positions([[vocabulary.term(term_id) for term_id in terms] for terms in fields]))
+        INSTRUMENT.count("postings", len(doc_dict))
     return doc_dict
@@ -0,0 +1,117 @@
+import os
+import sys
+
+IO_BUFFER = 1 << 20
+# Bytes taken by the bytearray of a postings list besides its content and its list slot
+BYTEARRAY_OVERHEAD = sys.getsizeof(bytearray()) + 8
+
+
+class PostingsAccumulator:
+    """Stage 1 postings lists held as bytearrays of count-docid-tags postings indexed by the term ids of a
+    vocabulary, with an estimate of the memory they and the vocabulary take"""
+
+    def __init__(self, vocabulary):
+        self.vocabulary = vocabulary
+        self.postings = []
+        self.postings_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self.postings)
+
+    @property
+    def memory(self) -> int:
+        """Estimated bytes held, bytearrays over-allocate by about an eighth when they grow"""
+        return self.vocabulary.memory + len(self.postings) * BYTEARRAY_OVERHEAD + self.postings_bytes * 9 // 8
+
+    def add(self, doc_tokens: dict) -> None:
+        """Append the postings of a document keyed by term id, documents must be added in doc id order"""
+        postings = self.postings
+        if len(postings) < len(self.vocabulary):
+            postings.extend([None] * (len(self.vocabulary) - len(postings)))
+        for term_id, val in doc_tokens.items():
+            doc_string = f"{val['count']}-{val['doc_id']}"
+            if len(val["pos"]):
+                doc_string += "-" + "".join(sorted(val["pos"]))
+            postings_list = postings[term_id]
+            if postings_list is None:
+                postings[term_id] = bytearray(doc_string.encode())
+                self.postings_bytes += len(doc_string)
+            else:
+                postings_list += b" "
+                postings_list += doc_string.encode()
+                self.postings_bytes += len(doc_string) + 1
+
+    def write_run(self, path_to_run: str) -> None:
+        """Write the postings as a sorted stage 1 index file"""
+        terms = self.vocabulary.terms
+        with open(path_to_run, 'wb', buffering=IO_BUFFER) as f:
+            is_first = True
+            for term_id in sorted(range(len(self.postings)), key=terms.__getitem__):
+                if self.postings[term_id] is None:
+                    continue
+                if not is_first:
+                    f.write(b"\n")
+                is_first = False
+                f.write(terms[term_id].encode())
+                f.write(b" ")
+                f.write(self.postings[term_id])
+
+    def reset(self) -> None:
+        """Drop the postings and the terms, whose ids are only valid until the next stage 1 index file"""
+        self.vocabulary.reset()
+        self.postings = []
+        self.postings_bytes = 0
+
+
+def open_run(path_to_run: str):
+    return open(path_to_run, 'rb', buffering=IO_BUFFER)
+
+
+def line_at(f, pos: int) -> tuple:
+    """Start and token of the first line of a stage 1 index file starting at or after pos, the token is None at the
+    end of the file"""
+    if pos == 0:
+        f.seek(0)
+    else:
+        f.seek(pos - 1)
+        f.readline()
+    start = f.tell()
+    line = f.readline()
+    return start, line.split(b" ", 1)[0] if len(line) else None
+
+
+def seek_to_token(f, token: bytes) -> None:
+    """Position a stage 1 index file at its first line whose token is not smaller than the given token"""
+    low, high = 0, os.fstat(f.fileno()).st_size
+    while low < high:
+        mid = (low + high) // 2
+        start, line_token = line_at(f, mid)
+        if line_token is not None and line_token < token:
+            low = max(mid, start) + 1
+        else:
+            high = mid
+    f.seek(line_at(f, low)[0])
+
+
+def sample_boundaries(run_paths: list, parts: int, samples: int = 64) -> list:
+    """Tokens splitting the stage 1 index files into ranges of about equal size, estimated from tokens sampled at
+    evenly spaced byte offsets of each file"""
+    sampled = []
+    for path in run_paths:
+        size = os.path.getsize(path)
+        with open_run(path) as f:
+            for ind in range(1, samples + 1):
+                token = line_at(f, size * ind // (samples + 1))[1]
+                if token is not None:
+                    sampled.append((token, size / (samples + 1)))
+
+    sampled.sort()
+    total = sum(weight for _, weight in sampled)
+    boundaries = []
+    seen = 0
+    for token, weight in sampled:
+        seen += weight
+        if seen >= total * (len(boundaries) + 1) / parts and len(boundaries) < parts - 1:
+            if len(boundaries) == 0 or token > boundaries[-1]:
+                boundaries.append(token)
+    return boundaries
@@ -1,44 +1,150 @@
 #!/usr/bin/python
+import argparse
+from array import array
 import bisect
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+from itertools import islice
 import math
+import multiprocessing
 import os
-import Stemmer
-import sys
+import re
 import timeit
 
-from processing import STOPWORDS
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from cache import LRUCache, ResultCache, postings_size
+from index_format import tags_to_mask
+from instrument import INSTRUMENT
+from segments import IndexSegment, index_stamp, read_manifest
+from vocabulary import Vocabulary
+
+# (handler, parsed queries, phrases, postings) of the batch ranked by the forked worker processes
+BATCH = None
+PHRASE_REGEX = re.compile(r'"([^"]*)"')
 
 
 class SearchHandler:
     """Main Search Class"""
 
-    def __init__(self, index_path: str):
+    def __init__(self, index_path: str, cache_bytes: int = 0, scoring: str = "bm15", result_cache: ResultCache = None,
+                 top_tiers: bool = False, io_workers: int = 0):
         self.index_path = index_path
-        self.file_per_page = 10000
-
-        with open(os.path.join(index_path, 'first_words.txt'), 'r') as f:
-            self.first_words = f.readline().rstrip().split(" ")
-
-        with open(os.path.join(index_path, 'page_count.txt'), 'r') as f:
-            self.total_pages = int(f.readline().rstrip())
-
+        self.scoring = scoring
+        self.top_tiers = top_tiers
+        # threads reading the postings lists and titles of a query concurrently, None reads them in turn
+        self.read_executor = ThreadPoolExecutor(io_workers) if io_workers > 1 else None
+        self.vectorized = np is not None
+        self.conjunctive = False
+        self.generation = None
+        self.index_stamp = None
+        self.segments = []
+        self.segment_bases = []
+        self.total_pages = 0
+        self.total_length = 0
+        self.shard = 0
+        self.shard_count = 1
+        self.doc_lengths = None
+        self.doc_lengths_array = None
+        self.avg_doc_length = 0
+        self.min_norm = 1.0
         self.search_results = 10
-        self.stemmer = Stemmer.Stemmer('english')
+        self.vocabulary = Vocabulary(max_words=1 << 16)
 
         self.index = {}
-        self.token_set = {}
         self.token_dict = {}
+        self.phrases = []
         self.idf = {}
-        self.doc_file_map = {str(k): set() for k in range(1, self.total_pages // self.file_per_page + 2)}
+        self.max_tf = {}
+        self.low_tiers = {}
+        self.term_order = []
         self.doc_score = []
         self.results = []
+        self.postings_cache = LRUCache(cache_bytes) if cache_bytes > 0 else None
+        self.result_cache = result_cache
+        self.load_segments()
+
+    def load_segments(self) -> None:
+        """Open the live segments of a segmented index, or the index itself as a single segment. Segments are
+        reloaded when the indexer commits a new generation of the segment list or rebuilds the single index"""
+        manifest = read_manifest(self.index_path)
+        old_segments = self.segments
+        if manifest is None:
+            stamp = index_stamp(self.index_path)
+            if len(self.segments) and (stamp is None or stamp == self.index_stamp):
+                return
+            self.index_stamp = stamp
+            self.segments = [IndexSegment(self.index_path)]
+        elif manifest["generation"] != self.generation:
+            self.generation = manifest["generation"]
+            self.segments = []
+            base = 0
+            for segment in manifest["segments"]:
+                self.segments.append(IndexSegment(os.path.join(self.index_path, segment["name"]), base=base))
+                base += segment["docs"]
+        else:
+            return
+        for segment in old_segments:
+            segment.close()
+        if self.postings_cache is not None:
+            self.postings_cache.clear()
+
+        self.segment_bases = [segment.base for segment in self.segments]
+        if self.result_cache is not None:
+            self.result_cache.set_generation(f"{self.generation}:" +
+                                             ",".join(segment.build_id for segment in self.segments))
+        self.total_pages = sum(segment.doc_count - len(segment.deleted) for segment in self.segments)
+        self.shard, self.shard_count = self.segments[0].shard, self.segments[0].shard_count
+        if self.scoring == "bm25":
+            self.load_doc_lengths()
+
+    def load_doc_lengths(self) -> None:
+        """Lengths of all the documents indexed by doc id, the average length of the live documents and the smallest
+        length normalization, which bounds the score a word can add to a document"""
+        lengths = array("I", [0])
+        total_length = 0
+        for segment in self.segments:
+            if segment.doc_lengths is None:
+                raise ValueError(f"{segment.path} was indexed without document lengths, which BM25 needs")
+            lengths.frombytes(bytes(segment.doc_lengths))
+            total_length += sum(segment.doc_lengths) - sum(segment.doc_lengths[doc - 1] for doc in segment.deleted)
+        self.doc_lengths = lengths
+        self.doc_lengths_array = np.frombuffer(lengths, dtype=np.uint32) if np is not None else None
+        self.total_length = total_length
+        self.set_collection_stats(self.total_pages, total_length)
+
+    def set_collection_stats(self, pages: int, total_length: int) -> None:
+        """Set the number of live documents and, for BM25, their average length, which the scores are computed
+        from"""
+        self.total_pages = pages
+        if self.doc_lengths is not None:
+            self.avg_doc_length = total_length / max(1, pages)
+            self.min_norm = self.doc_norm(min(self.doc_lengths[1:], default=0))
+
+    def doc_norm(self, length: int) -> float:
+        """BM25 length normalization of a document of the given length"""
+        b = 0.75
+        return 1 - b + b * length / self.avg_doc_length
+
+    def idf_of(self, doc_freq: int) -> float:
+        return math.log(1 + (self.total_pages - doc_freq + 0.5) / (doc_freq + 0.5))
 
     def parse_query(self, query: str):
-        """Tokenize Individual Query to find Tokens and Fields"""
-        query = query.replace(",", " ").split()
+        """Tokenize Individual Query to find Tokens and Fields, and the stemmed terms of its quoted phrases"""
+        if len(self.vocabulary) >= self.vocabulary.max_words:
+            self.vocabulary.reset()
+        self.phrases = []
+        for phrase in PHRASE_REGEX.findall(query):
+            terms = self.vocabulary.stem([token.split(":")[-1].lower() for token in phrase.replace(",", " ").split()
+                                          if len(token.split(":")[-1])])
+            if len(terms):
+                self.phrases.append(terms)
+        query = query.replace('"', " ").replace(",", " ").split()
         pos = ''
         self.token_dict = {}
-        self.token_set = {}
         for ind in range(len(query)):
             token = query[ind]
             query_list = token.split(':')
@@ -58,127 +164,560 @@ class SearchHandler:
                     pos = token
                     continue
 
-            stemmed_token = self.stemmer.stemWord(token.lower())
-            if stemmed_token in STOPWORDS:
+            terms = self.vocabulary.stem([token.lower()])
+            if len(terms) == 0:
                 continue
+            stemmed_token = terms[0]
 
             if stemmed_token in self.token_dict:
                 self.token_dict[stemmed_token]["count"] += 1
                 self.token_dict[stemmed_token]["tag"].add(pos)
             else:
-                file_num = bisect.bisect_left(self.first_words, stemmed_token)
-                file_num = file_num + 1 if file_num < len(self.first_words) and self.first_words[
-                    file_num] == stemmed_token else file_num
-                if file_num in self.token_set:
-                    self.token_set[file_num].add(stemmed_token)
-                else:
-                    self.token_set[file_num] = {stemmed_token}
-
                 self.token_dict[stemmed_token] = {"count": 1, "tag": set(pos)}
 
-    def parse_query_file(self, query_file: str):
-        """Parse Individual Query for Searching and display final results"""
-        final_op = ""
-        with open(query_file, 'r') as f:
-            for _query in f:
-                final_result = ""
-                start = timeit.default_timer()
-                query = _query.rstrip()
-                self.parse_query(query=query)
-
+    def query_key(self) -> tuple:
+        """Key of the parsed query in the result cache, queries differing only in the order, case or inflection of
+        their words share a key"""
+        terms = tuple(sorted((word, entry["count"], "".join(sorted(entry["tag"])))
+                             for word, entry in self.token_dict.items()))
+        phrases = tuple(tuple(phrase) for phrase in self.phrases)
+        return terms, phrases, self.conjunctive, self.search_results, self.scoring, self.top_tiers
+
+    def search(self, query: str) -> list:
+        """Run a single query and return the (doc id, score, title, wikipedia page id) of the top results"""
+        INSTRUMENT.count("queries")
+        self.load_segments()
+        with INSTRUMENT.phase("parse_query"):
+            self.parse_query(query=query)
+        key = None
+        if self.result_cache is not None:
+            key = self.query_key()
+            cached = self.result_cache.get(key)
+            if cached is not None:
+                INSTRUMENT.count("result_cache_hits")
+                self.reset()
+                return list(cached)
+        with INSTRUMENT.phase("get_index"):
+            if self.conjunctive or len(self.phrases):
+                self.get_index_conjunctive()
+            else:
                 self.get_index()
-                self.get_doc_score()
-                self.get_titles()
+        with INSTRUMENT.phase("get_doc_score"):
+            self.get_doc_score()
+        with INSTRUMENT.phase("get_titles"):
+            self.get_titles()
+        results = self.results
+        if key is not None:
+            self.result_cache.put(key, list(results))
+        self.reset()
+        return results
+
+    def shard_stats(self, query: str) -> dict:
+        """Statistics of a query on one shard of a sharded index: the live documents, their total length and the
+        document frequency each word's idf is computed from, which the coordinator sums over the shards"""
+        self.load_segments()
+        self.parse_query(query=query)
+        if self.conjunctive or len(self.phrases):
+            self.order_terms()
+            doc_freq = self.term_doc_freq()
+        else:
+            self.get_index()
+            doc_freq = {word: len(docs) + self.pruned_doc_freq(word, self.token_dict[word]["tag"]) +
+                        self.low_tiers.get(word, (0,))[0] for word, (docs, _) in self.index.items()}
+        self.reset()
+        return {"pages": self.total_pages, "length": self.total_length, "df": doc_freq, "shard": self.shard,
+                "shards": self.shard_count}
+
+    def search_shard(self, query: str, stats: dict) -> list:
+        """Rank a query on one shard with the statistics summed over all the shards, so that the scores are those
+        of the unsharded index, and return the results with the doc ids of the unsharded index"""
+        self.load_segments()
+        local_stats = self.total_pages, self.total_length
+        try:
+            self.parse_query(query=query)
+            if self.conjunctive or len(self.phrases):
+                self.get_index_conjunctive()
+            else:
+                self.get_index()
+            self.set_collection_stats(stats["pages"], stats["length"])
+            for word in self.idf:
+                self.idf[word] = self.idf_of(stats["df"].get(word, 0))
+            self.get_doc_score()
+            self.get_titles()
+            return [(self.global_doc(doc), score, title, page_id) for doc, score, title, page_id in self.results]
+        finally:
+            self.set_collection_stats(*local_stats)
+            self.reset()
+
+    def global_doc(self, doc: int) -> int:
+        """Doc id in the unsharded index of a doc id of this shard, the shards take the articles in turn"""
+        return (doc - 1) * self.shard_count + self.shard + 1
+
+    def reset(self) -> None:
+        """Clear the state of the last query"""
+        self.token_dict = {}
+        self.phrases = []
+        self.index = {}
+        self.idf = {}
+        self.max_tf = {}
+        self.low_tiers = {}
+        self.term_order = []
+        self.doc_score = []
+        self.results = []
 
-                if len(self.results) == 0:
-                    final_result += "NO RESULTS FOUND"
+    def search_batch(self, queries: list, workers: int = 1):
+        """Yield the results and seconds of each query of a batch, reading each postings list once per batch"""
+        global BATCH
+        start = timeit.default_timer()
+        INSTRUMENT.count("queries", len(queries))
+        self.load_segments()
+        token_dicts = []
+        phrases = []
+        with INSTRUMENT.phase("parse_query"):
+            for query in queries:
+                self.parse_query(query=query)
+                token_dicts.append(self.token_dict)
+                phrases.append(self.phrases)
+        self.reset()
+        with INSTRUMENT.phase("read_batch"):
+            postings = self.read_batch(token_dicts)
+        read_seconds = (timeit.default_timer() - start) / len(queries)
+
+        if workers <= 1:
+            for token_dict, query_phrases in zip(token_dicts, phrases):
+                start = timeit.default_timer()
+                results = self.rank(token_dict, postings, query_phrases)
+                yield results, read_seconds + timeit.default_timer() - start
+            return
+
+        BATCH = (self, token_dicts, phrases, postings)
+        try:
+            with multiprocessing.get_context("fork").Pool(workers, initializer=INSTRUMENT.take) as pool:
+                for results, seconds, report in pool.imap(rank_batch_query, range(len(token_dicts)),
+                                                          chunksize=max(1, len(token_dicts) // (workers * 8))):
+                    INSTRUMENT.merge(report)
+                    yield results, read_seconds + seconds
+        finally:
+            BATCH = None
+
+    def read_batch(self, token_dicts: list) -> dict:
+        """Filtered postings of every word and query fields of a batch of parsed queries"""
+        batch = {}
+        words = {}
+        for token_dict in token_dicts:
+            for word, token in token_dict.items():
+                key = (word, frozenset(token["tag"]))
+                if key in batch or key in words:
+                    continue
+                cached = self.postings_cache.get(key) if self.postings_cache is not None else None
+                if cached is None:
+                    words[key] = (word, token["tag"])
                 else:
-                    final_result = "\n".join(self.results)
-
-                stop = timeit.default_timer()
-                final_result += f"\n{stop - start}\n\n"
-
-                final_op += final_result
-
-                self.token_set = {}
-                self.token_dict = {}
-                self.index = {}
-                self.idf = {}
-                self.doc_file_map = {str(k): set() for k in range(1, self.total_pages // self.file_per_page + 2)}
-                self.doc_score = []
-                self.results = []
+                    INSTRUMENT.count("cache_hits")
+                    batch[key] = cached
+        if self.postings_cache is not None:
+            INSTRUMENT.count("cache_misses", len(words))
+
+        for key, postings in self.read_segments(words).items():
+            INSTRUMENT.count("postings_read", len(postings[0]))
+            batch[key] = self.filter_postings(key[1], postings, self.pruned_doc_freq(*key))
+            if self.postings_cache is not None:
+                self.postings_cache.put(key, batch[key], postings_size(*batch[key][:2]))
+        return batch
+
+    def rank(self, token_dict: dict, batch: dict, phrases: list) -> list:
+        """Rank a parsed query of a batch using the postings read for the batch, conjunctive queries and queries
+        with phrases read their own postings"""
+        self.token_dict = token_dict
+        self.phrases = phrases
+        if self.conjunctive or len(phrases):
+            self.get_index_conjunctive()
+        else:
+            self.order_terms()
+            for word in self.term_order:
+                key = (word, frozenset(token_dict[word]["tag"]))
+                if key in batch:
+                    self.set_postings(word, batch[key])
+        with INSTRUMENT.phase("get_doc_score"):
+            self.get_doc_score()
+        with INSTRUMENT.phase("get_titles"):
+            self.get_titles()
+        results = self.results
+        self.reset()
+        return results
+
+    def parse_query_file(self, query_file: str, batch_size: int = 0, workers: int = 1):
+        """Run the queries of a file and write their results to query_op.txt in order as soon as they are ranked,
+        queries are run in batches of batch_size queries if it is set"""
+        with open(query_file, 'r') as f, open("query_op.txt", 'w') as out:
+            if batch_size:
+                queries = (_query.rstrip() for _query in f)
+                while len(batch := list(islice(queries, batch_size))):
+                    for results, seconds in self.search_batch(batch, workers=workers):
+                        out.write(format_results(results, seconds))
+                return
 
-        with open("query_op.txt", 'w') as f:
-            f.write(final_op)
+            for _query in f:
+                start = timeit.default_timer()
+                results = self.search(_query.rstrip())
+                out.write(format_results(results, timeit.default_timer() - start))
 
     def get_doc_score(self) -> None:
-        """Calculate Score for each doc by summation of score of each word"""
-        for file_num, docs in self.doc_file_map.items():
-            if len(docs) == 0:
-                continue
-            for _doc in docs:
+        """Find the top documents with MaxScore dynamic pruning"""
+        if len(self.low_tiers):
+            self.get_doc_score_tiered()
+            return
+        if self.vectorized:
+            self.get_doc_score_vectorized()
+            return
+
+        words = [word for word in self.term_order if word in self.index and len(self.index[word][0])]
+        upper_bound = {word: self.token_dict[word]["count"] * self.scoring_func(
+            self.max_tf[word], self.idf[word], self.min_norm) * (1 + 1e-9) for word in words}
+        order = sorted(words, key=lambda w: upper_bound[w])
+        bound_sum = []
+        for word in order:
+            bound_sum.append(upper_bound[word] + (bound_sum[-1] if len(bound_sum) else 0))
+        pointer = {word: 0 for word in words}
+        heap = []
+        threshold = 0
+        essential = 0
+
+        while essential < len(order):
+            doc = min((self.index[word][0][pointer[word]] for word in order[essential:] if
+                       pointer[word] < len(self.index[word][0])), default=None)
+            if doc is None:
+                break
+
+            norm = self.doc_norm(self.doc_lengths[doc]) if self.doc_lengths is not None else 1.0
+            contribution = {}
+            for word in order[essential:]:
+                docs, tfs = self.index[word]
+                if pointer[word] < len(docs) and docs[pointer[word]] == doc:
+                    contribution[word] = self.token_dict[word]["count"] * self.scoring_func(tfs[pointer[word]],
+                                                                                            self.idf[word], norm)
+                    pointer[word] += 1
+
+            score = sum(contribution.values())
+            for ind in range(essential - 1, -1, -1):
+                if score + bound_sum[ind] < threshold:
+                    break
+                word = order[ind]
+                docs, tfs = self.index[word]
+                pointer[word] = bisect.bisect_left(docs, doc, pointer[word])
+                if pointer[word] < len(docs) and docs[pointer[word]] == doc:
+                    contribution[word] = self.token_dict[word]["count"] * self.scoring_func(tfs[pointer[word]],
+                                                                                            self.idf[word], norm)
+                    score += contribution[word]
+            else:
                 score = 0
-                for word in self.index:
-                    score += self.token_dict[word]["count"] * self.scoring_func(self.index[word][_doc],
-                                                                                self.idf[word]) if _doc in self.index[
-                        word] else 0
-
-                if score != 0:
-                    self.doc_score.append((_doc, score))
-
-        self.doc_score = sorted(self.doc_score, key=lambda x: x[1], reverse=True)[:self.search_results]
-
-    def scoring_func(self, tf: float, idf: float) -> float:
-        """Scoring Function BM-15"""
+                for word in self.term_order:
+                    score += contribution.get(word, 0)
+                if len(heap) < self.search_results:
+                    heapq.heappush(heap, (score, -doc))
+                elif (score, -doc) > heap[0]:
+                    heapq.heapreplace(heap, (score, -doc))
+
+                if len(heap) == self.search_results:
+                    threshold = heap[0][0]
+                    while essential < len(order) and bound_sum[essential] < threshold:
+                        essential += 1
+
+        self.doc_score = [(-doc, score) for score, doc in sorted(heap, reverse=True)]
+
+    def get_doc_score_tiered(self) -> None:
+        """Rank the top impact tiers first and read the low tiers only as far as the ranking needs them"""
+        low_tiers, self.low_tiers = self.low_tiers, {}
+        bound = sum(self.token_dict[word]["count"] * self.scoring_func(max_count, self.idf[word], self.min_norm)
+                    for word, (_, max_count) in low_tiers.items()) * (1 + 1e-9)
+        self.search_results += 1
+        try:
+            self.get_doc_score()
+        finally:
+            self.search_results -= 1
+
+        top = self.search_results
+        words = {word: (word, set()) for word in low_tiers}
+        scores = [score for _, score in self.doc_score]
+        if self.top_tiers or (len(scores) >= top and scores[top - 1] > (scores[top] if len(scores) > top else 0) +
+                              bound):
+            INSTRUMENT.count("low_tiers_probed", len(words))
+            docs = sorted(doc for doc, _ in self.doc_score[:top])
+            low_postings = self.read_segments(words, docs, tier="low")
+            wanted = set(docs)
+            for word, (word_docs, tfs) in self.index.items():
+                keep = [ind for ind, doc in enumerate(word_docs) if doc in wanted]
+                self.index[word] = ([word_docs[ind] for ind in keep], [tfs[ind] for ind in keep])
+        else:
+            INSTRUMENT.count("low_tiers_read", len(words))
+            low_postings = self.read_segments(words, tier="low")
+
+        for word, (low_docs, low_tfs, _, _) in low_postings.items():
+            INSTRUMENT.count("postings_read", len(low_docs))
+            merged = sorted(zip(self.index[word][0] + low_docs, self.index[word][1] + low_tfs))
+            self.index[word] = ([doc for doc, _ in merged], [tf for _, tf in merged])
+        self.doc_score = []
+        self.get_doc_score()
+
+    def get_doc_score_vectorized(self) -> None:
+        """Score every document of the postings lists at once with NumPy"""
+        words = [word for word in self.term_order if word in self.index and len(self.index[word][0])]
+        if len(words) == 0:
+            return
+        word_docs = [np.asarray(self.index[word][0], dtype=np.int64) for word in words]
+        weights = []
+        for word, docs in zip(words, word_docs):
+            tfs = np.asarray(self.index[word][1], dtype=np.float64)
+            norm = self.doc_norm(self.doc_lengths_array[docs]) if self.doc_lengths is not None else 1.0
+            weights.append(self.token_dict[word]["count"] * self.scoring_func(tfs, self.idf[word], norm))
+
+        docs, inverse = np.unique(np.concatenate(word_docs), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(weights))
+        top = min(self.search_results, len(docs))
+        if top < len(docs):
+            keep = scores >= np.partition(scores, len(docs) - top)[len(docs) - top]
+            docs, scores = docs[keep], scores[keep]
+        order = np.lexsort((docs, -scores))[:top]
+        self.doc_score = list(zip(docs[order].tolist(), scores[order].tolist()))
+
+    def scoring_func(self, tf: float, idf: float, norm: float = 1.0) -> float:
+        """Scoring Function BM-15, or BM-25 given the length normalization of the document"""
         k1 = 1.2
-        return idf * (1 + (tf * (k1 + 1)) / (tf + k1))
+        return idf * (1 + (tf * (k1 + 1)) / (tf + k1 * norm))
 
     def get_titles(self) -> None:
-        """Get titles for each document"""
-        for doc, score in self.doc_score:
-            file_num = (doc - 1) // self.file_per_page + 1
-            title_path = os.path.join(self.index_path, f"title_{file_num}.txt")
-            with open(title_path, 'r') as f:
-                lines = f.readlines()
-
-            self.results.append(f"{doc}, {score}, " + lines[(doc - 1) % self.file_per_page].rstrip())
+        """Get the title and page id of each document, the titles are read concurrently if there is a read
+        executor"""
+        segments = [self.segments[bisect.bisect_left(self.segment_bases, doc) - 1] for doc, _ in self.doc_score]
+        if self.read_executor is None:
+            titles = [segment.title(doc - segment.base) for segment, (doc, _) in zip(segments, self.doc_score)]
+        else:
+            titles = [future.result() for future in [self.read_executor.submit(
+                segment.read_title, doc - segment.base) for segment, (doc, _) in zip(segments, self.doc_score)]]
+        for (doc, score), title in zip(self.doc_score, titles):
+            self.results.append((doc, score) + title)
+
+    def order_terms(self) -> None:
+        """Order the query words alphabetically, which is also the order of their index files. The scores of the words
+        are summed in this order, so it must not depend on how the documents are split into segments or shards"""
+        self.term_order = sorted(self.token_dict)
+
+    def read_segments(self, words: dict, docs: list = None, tier: str = None) -> dict:
+        """Postings of each key of words, which maps the key to a word and its query fields, combined over the
+        live segments, read from the given impact tier and restricted to the sorted doc ids docs if they are given"""
+        postings = {}
+        for segment in self.segments:
+            segment_postings = segment.read_postings(words, tier, self.read_executor) if docs is None else \
+                segment.probe_postings(words, docs, tier, self.read_executor)
+            for key, (doc_ids, counts, masks, max_count) in segment_postings.items():
+                if key in postings:
+                    postings[key][0].extend(doc_ids)
+                    postings[key][1].extend(counts)
+                    postings[key][2].extend(masks)
+                    postings[key][3] = max(postings[key][3], max_count)
+                else:
+                    postings[key] = [list(doc_ids), list(counts), bytearray(masks), max_count]
+        return postings
 
     def get_index(self) -> None:
         """Read index to get desired documents and posting lists"""
-        for file, stem_words in self.token_set.items():
-            if file == 0:
+        self.order_terms()
+        words = [word for word in self.term_order if not self.load_cached_postings(word)]
+        low_tiers = {}
+        for word in words:
+            if len(self.token_dict[word]["tag"]) == 0:
+                entries = [(entry, len(segment.deleted)) for segment in self.segments if not segment.pruned and
+                           (entry := segment.low_entry(word, set())) is not None]
+                # the doc frequency of a low tier counts its deleted documents, read such words in full
+                if len(entries) and not any(deleted for _, deleted in entries):
+                    low_tiers[word] = (sum(entry[3] for entry, _ in entries), max(entry[4] for entry, _ in entries))
+        postings = self.read_segments({word: (word, self.token_dict[word]["tag"]) for word in words if
+                                       word not in low_tiers})
+        postings.update(self.read_segments({word: (word, set()) for word in low_tiers}, tier="top"))
+
+        for word in words:
+            if word not in postings:
                 continue
-            index_path = os.path.join(self.index_path, f"index2_{file}.txt")
-            with open(index_path, 'r') as f:
-                for _line in f:
-                    if len(self.token_set[file]) == 0:
-                        break
-                    token_line = _line.rstrip().split(" ")
-                    word = token_line[0]
-                    token_line = token_line[1:]
-                    if word not in self.token_set[file]:
-                        continue
-                    self.token_set[file].remove(word)
-
-                    docs = {doc_id: int(doc[0]) for _doc in token_line if
-                            (doc := _doc.split("-")) != "" and (doc_id := int(doc[1])) != "" and (
-                                    self.token_dict[word]["tag"].issubset(doc[-1]) or (
-                                        self.token_dict[word]["tag"] == {"b"} and len(doc) <= 2))}
-
-                    [self.doc_file_map[f"{(d - 1) // self.file_per_page + 1}"].add(d) for d in docs]
-                    if word not in self.idf:
-                        self.idf[word] = math.log(
-                            1 + (self.total_pages - len(docs) + 0.5) / (len(docs) + 0.5))
-                    self.index[word] = docs
+            INSTRUMENT.count("postings_read", len(postings[word][0]))
+            if word in low_tiers:
+                self.low_tiers[word] = low_tiers[word]
+                self.set_postings(word, self.filter_postings(set(), postings[word], low_tiers[word][0] +
+                                                             self.pruned_doc_freq(word, set())))
+            else:
+                self.add_postings(word, postings[word])
+
+    def get_index_conjunctive(self) -> None:
+        """Read the postings of the query words restricted to the documents matching all the required words"""
+        self.order_terms()
+        tags = {word: self.token_dict[word]["tag"] for word in self.term_order}
+        doc_freq = self.term_doc_freq()
+        phrase_words = {word for phrase in self.phrases for word in phrase}
+        required = sorted([word for word in self.term_order if self.conjunctive or word in phrase_words],
+                          key=doc_freq.get)
+        if len(required) == 0:
+            return
+
+        postings = {}
+        docs = None
+        for word in required:
+            word_postings = self.read_segments({word: (word, tags[word])}, docs).get(word)
+            if word_postings is None:
+                docs = []
+                break
+            docs, tfs, _, max_count = self.filter_postings(tags[word], word_postings)
+            postings[word] = (docs, tfs, max_count)
+            if len(docs) == 0:
+                break
+        if len(self.phrases):
+            docs = [doc for doc in docs if self.has_phrases(doc)]
+
+        optional = {word: (word, tags[word]) for word in self.term_order if word not in postings}
+        if len(docs) and len(optional):
+            for word, word_postings in self.read_segments(optional, docs).items():
+                word_docs, tfs, _, max_count = self.filter_postings(tags[word], word_postings)
+                postings[word] = (word_docs, tfs, max_count)
+
+        docs = set(docs)
+        for word, (word_docs, tfs, max_count) in postings.items():
+            keep = [ind for ind, doc in enumerate(word_docs) if doc in docs]
+            self.index[word] = ([word_docs[ind] for ind in keep], [tfs[ind] for ind in keep])
+            self.idf[word] = self.idf_of(doc_freq[word])
+            self.max_tf[word] = max_count
+
+    def term_doc_freq(self) -> dict:
+        """Document frequency of each ordered query word in the query fields, counted as in filter_postings"""
+        doc_freq = {}
+        for word in self.term_order:
+            tag = self.token_dict[word]["tag"]
+            doc_freq[word] = self.pruned_doc_freq(word, tag)
+            for segment in self.segments:
+                if len(segment.deleted) == 0 and (len(tag) == 0 or len(tag) == 1 and segment.uses_field_dicts(tag)):
+                    doc_freq[word] += segment.doc_freq(word, tag) - segment.pruned_doc_freq(word, tag)
+                elif word in (postings := segment.read_postings({word: (word, tag)})):
+                    doc_freq[word] += len(self.filter_postings(tag, postings[word])[0])
+        return doc_freq
+
+    def has_phrases(self, doc: int) -> bool:
+        """Whether all the phrases of the query are found in a document, segments without positions only require
+        the words of the phrases"""
+        segment = self.segments[bisect.bisect_left(self.segment_bases, doc) - 1]
+        if segment.positions is None:
+            return True
+        return all(segment.positions.has_phrase(doc - segment.base, phrase) for phrase in self.phrases)
+
+    def load_cached_postings(self, word: str) -> bool:
+        """Use the cached filtered postings of a word if present"""
+        if self.postings_cache is None:
+            return False
+        cached = self.postings_cache.get((word, frozenset(self.token_dict[word]["tag"])))
+        if cached is None:
+            INSTRUMENT.count("cache_misses")
+            return False
+        INSTRUMENT.count("cache_hits")
+        self.set_postings(word, cached)
+        return True
+
+    def set_postings(self, word: str, postings: tuple) -> None:
+        """Use the filtered (doc ids, counts, idf, max count) postings of a word"""
+        docs, tfs, self.idf[word], self.max_tf[word] = postings
+        self.index[word] = (docs, tfs)
+
+    def pruned_doc_freq(self, word: str, tag: set) -> int:
+        """Documents of the word dropped from the index by pruning, which are counted in its idf. The pruned documents
+        holding the word in the query fields are unknown"""
+        if len(tag):
+            return 0
+        return sum(segment.pruned_doc_freq(word, tag) for segment in self.segments)
+
+    def add_postings(self, word: str, postings: list) -> None:
+        """Filter the postings of a word by the query fields and store them with the idf"""
+        tag = self.token_dict[word]["tag"]
+        filtered = self.filter_postings(tag, postings, self.pruned_doc_freq(word, tag))
+        self.set_postings(word, filtered)
+        if self.postings_cache is not None:
+            self.postings_cache.put((word, frozenset(tag)), filtered, postings_size(*filtered[:2]))
+
+    def filter_postings(self, tag: set, postings: list, missing_docs: int = 0) -> tuple:
+        """(doc ids, counts, idf, max count) of the postings of a word restricted to the query fields, the idf also
+        counts the missing documents of the word which are not in the postings"""
+        doc_ids, counts, masks, max_count = postings
+        if len(tag) == 0:
+            docs, tfs = doc_ids, counts
+        else:
+            tag_mask = tags_to_mask("".join(tag))
+            body_only = tag == {"b"}
+            keep = [ind for ind, mask in enumerate(masks) if
+                    (tag_mask != -1 and mask & tag_mask == tag_mask) or (body_only and mask == 0)]
+            docs, tfs = [doc_ids[ind] for ind in keep], [counts[ind] for ind in keep]
+
+        return docs, tfs, self.idf_of(len(docs) + missing_docs), max_count
+
+
+def rank_batch_query(ind: int) -> tuple:
+    """Rank a query of the batch in a forked worker process, returns its results, seconds and instrumentation"""
+    handler, token_dicts, phrases, postings = BATCH
+    # the threads of the read executor are not forked with the process
+    handler.read_executor = None
+    start = timeit.default_timer()
+    results = handler.rank(token_dicts[ind], postings, phrases[ind])
+    return results, timeit.default_timer() - start, INSTRUMENT.take() if INSTRUMENT.enabled else None
+
+
+def format_results(results: list, seconds: float) -> str:
+    if len(results) == 0:
+        final_result = "NO RESULTS FOUND"
+    else:
+        final_result = "\n".join([f"{doc}, {score}, {title}" for doc, score, title, _ in results])
+    return final_result + f"\n{seconds}\n\n"
 
 
 def main():
-    if len(sys.argv) < 3:
-        print("Usage :: python3 search.py path_to_inverted_index queries.txt")
-        sys.exit(0)
-
-    handler = SearchHandler(sys.argv[1])
-    handler.parse_query_file(sys.argv[2])
+    arg_parser = argparse.ArgumentParser(usage="python3 search.py path_to_inverted_index queries.txt [options]")
+    arg_parser.add_argument("path_to_index")
+    arg_parser.add_argument("query_file")
+    arg_parser.add_argument("--cache-mb", type=float, default=0,
+                            help="memory budget of the postings cache shared by the queries, 0 disables it")
+    arg_parser.add_argument("--instrument", default=None,
+                            help="time the search phases, count the work done and write a JSON report to this file")
+    arg_parser.add_argument("--profile", default=None,
+                            help="phase run under cProfile while instrumenting, such as get_index or get_doc_score")
+    arg_parser.add_argument("--batch-size", type=int, default=0,
+                            help="parse this many queries at once and read each postings list they need once, 0 runs "
+                                 "the queries one at a time")
+    arg_parser.add_argument("--workers", type=int, default=1,
+                            help="rank the queries of each batch in this many processes, with a batch size of 1000 if "
+                                 "none is given")
+    arg_parser.add_argument("--scoring", choices=["bm15", "bm25"], default="bm15",
+                            help="bm25 also normalizes the scores by the document lengths")
+    arg_parser.add_argument("--and", dest="conjunctive", action="store_true",
+                            help="only return documents holding all the words of the query")
+    arg_parser.add_argument("--top-tiers", action="store_true",
+                            help="rank the top impact tiers of an index split in tiers without reading its low tiers, "
+                                 "faster but the documents only found in the low tiers are missed")
+    arg_parser.add_argument("--io-workers", type=int, default=8,
+                            help="number of threads reading the postings lists and titles of a query concurrently, 1 "
+                                 "reads them in turn")
+    arg_parser.add_argument("--result-cache-mb", type=float, default=0,
+                            help="memory budget of the cache of query results, 0 disables it")
+    arg_parser.add_argument("--result-ttl", type=float, default=0,
+                            help="seconds a cached result is served for, 0 keeps it until the index changes")
+    arg_parser.add_argument("--result-cache-file", default=None,
+                            help="SQLite file keeping the cached results across runs")
+    args = arg_parser.parse_args()
+
+    if args.instrument is not None:
+        INSTRUMENT.enable(profile_phase=args.profile)
+    result_cache = None
+    if args.result_cache_mb > 0:
+        result_cache = ResultCache(int(args.result_cache_mb * 1e6), ttl=args.result_ttl or None,
+                                   path=args.result_cache_file)
+    handler = SearchHandler(args.path_to_index, cache_bytes=int(args.cache_mb * 1e6), scoring=args.scoring,
+                            result_cache=result_cache, top_tiers=args.top_tiers, io_workers=args.io_workers)
+    handler.conjunctive = args.conjunctive
+    batch_size = args.batch_size or (1000 if args.workers > 1 else 0)
+    handler.parse_query_file(args.query_file, batch_size=batch_size, workers=args.workers)
+    if args.instrument is not None:
+        INSTRUMENT.write_report(args.instrument)
 
 
 if __name__ == "__main__":
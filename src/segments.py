@@ -0,0 +1,355 @@
+import bisect
+from contextlib import contextmanager
+import fcntl
+from itertools import islice
+import json
+import os
+
+from index_format import BLOCK_SIZE, FIELDS, LOW_TIER_DICT_FILE, META_FILE, POSTINGS_EXTENSION, TERM_DICT_FILE, \
+    TITLE_OFFSETS_FILE, PositionStore, TermDictionary, TitleStore, decode_block, decode_postings, decode_skips, \
+    field_dict_file, open_index, parse_text_postings, read_doc_lengths, read_meta, skip_table_size, tags_to_mask, \
+    title_file
+
+SEGMENTS_FILE = "segments.json"
+LOCK_FILE = "segments.lock"
+PAGE_IDS_FILE = "page_ids.txt"
+DELETES_FILE = "deletes.txt"
+
+
+def merge_tiers(tiers: list) -> tuple:
+    """(doc ids, counts, field masks) of the postings of the impact tiers of a word merged back in doc id order"""
+    if len(tiers) == 1:
+        return tiers[0]
+    merged = sorted((doc, count, mask) for docs, counts, masks in tiers for doc, count, mask in
+                    zip(docs, counts, masks))
+    return [doc for doc, _, _ in merged], [count for _, count, _ in merged], bytearray(mask for _, _, mask in merged)
+
+
+def read_manifest(index_path: str):
+    """List of live segments of a segmented index, None for a single index"""
+    manifest_path = os.path.join(index_path, SEGMENTS_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def index_stamp(index_path: str):
+    """Modification time of the metadata of a single index or of its pack, which changes when the index is rebuilt in
+    place, None while it is missing"""
+    path = index_path if os.path.isfile(index_path) else os.path.join(index_path, META_FILE)
+    if not os.path.exists(path):
+        path = os.path.join(index_path, 'page_count.txt')
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def write_manifest(index_path: str, manifest: dict) -> None:
+    """Atomically replace the segment list and move to the next generation"""
+    manifest["generation"] += 1
+    tmp_path = os.path.join(index_path, SEGMENTS_FILE + ".tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, os.path.join(index_path, SEGMENTS_FILE))
+
+
+@contextmanager
+def manifest_lock(index_path: str):
+    """Exclusive lock serializing segment additions, deletes and merges of an index"""
+    with open(os.path.join(index_path, LOCK_FILE), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_deletes(segment_path: str) -> set:
+    """Local doc ids tombstoned in a segment"""
+    deletes_path = os.path.join(segment_path, DELETES_FILE)
+    if not os.path.exists(deletes_path):
+        return set()
+    with open(deletes_path, 'r') as f:
+        return {int(line) for line in f if line.strip()}
+
+
+def delete_pages(index_path: str, manifest: dict, page_ids: set) -> int:
+    """Tombstone the documents of the given wikipedia page ids in all the segments of the manifest"""
+    deleted_count = 0
+    for segment in manifest["segments"]:
+        segment_path = os.path.join(index_path, segment["name"])
+        deleted = read_deletes(segment_path)
+        with open(os.path.join(segment_path, PAGE_IDS_FILE), 'r') as f:
+            docs = [doc for doc, page_id in enumerate(f, 1) if page_id.rstrip() in page_ids and doc not in deleted]
+        if len(docs):
+            with open(os.path.join(segment_path, DELETES_FILE), 'a') as f:
+                f.write("".join(f"{doc}\n" for doc in docs))
+            deleted_count += len(docs)
+    return deleted_count
+
+
+def select_merge(index_path: str, manifest: dict, merge_factor: int, max_segments: int) -> list:
+    """Tiered merge policy: merge the merge_factor smallest segments while there are more than max_segments of
+    them, otherwise compact a single segment once most of its documents are deleted"""
+    live_docs = {}
+    for segment in manifest["segments"]:
+        live_docs[segment["name"]] = segment["docs"] - len(read_deletes(os.path.join(index_path, segment["name"])))
+
+    if len(live_docs) > max_segments:
+        return sorted(live_docs, key=lambda name: live_docs[name])[:merge_factor]
+
+    for segment in manifest["segments"]:
+        if live_docs[segment["name"]] * 2 < segment["docs"]:
+            return [segment["name"]]
+    return []
+
+
+class IndexSegment:
+    """Reader of a single index directory or index pack, either a whole index or one segment of a segmented index
+    whose doc ids are offset by base"""
+
+    def __init__(self, path: str, base: int = 0):
+        self.path = path
+        self.base = base
+        self.file_per_page = 10000
+        self.store = open_index(path)
+        meta = read_meta(self.store)
+        self.postings_format = meta["postings"]
+        self.skips = meta["skips"]
+        # indexes built before the build id was recorded are told apart by the time they were written
+        self.build_id = meta["build_id"] or str(os.path.getmtime(os.path.join(path, 'page_count.txt')))
+        self.shard = meta["shard"]
+        self.shard_count = meta["shards"]
+        self.field_dicts = {}
+        if meta["field_postings"]:
+            self.field_dicts = {field: TermDictionary(self.store.data(field_dict_file(field))) for field in FIELDS}
+        self.tiers = meta["tiers"]
+        self.pruned = self.tiers is not None and self.tiers["pruned"]
+        self.low_dict = TermDictionary(self.store.data(LOW_TIER_DICT_FILE)) if self.tiers is not None else None
+
+        self.term_dict = None
+        self.first_words = []
+        if self.store.exists(TERM_DICT_FILE):
+            self.term_dict = TermDictionary(self.store.data(TERM_DICT_FILE))
+        else:
+            self.first_words = self.store.text('first_words.txt').split("\n")[0].rstrip().split(" ")
+
+        self.doc_count = int(self.store.text('page_count.txt').split("\n")[0].rstrip())
+
+        self.title_store = None
+        if self.store.exists(TITLE_OFFSETS_FILE):
+            self.title_store = TitleStore(self.store)
+
+        self.doc_lengths = read_doc_lengths(self.store)
+        self.positions = PositionStore(self.store) if meta["positions"] else None
+        self.deleted = read_deletes(path)
+
+    def file_of(self, word: str) -> int:
+        """Number of the index file which may contain the word, 0 if no file can contain it"""
+        if self.term_dict is not None:
+            entry = self.term_dict.lookup(word)
+            return entry[0] if entry is not None else 0
+
+        file_num = bisect.bisect_left(self.first_words, word)
+        return file_num + 1 if file_num < len(self.first_words) and self.first_words[file_num] == word else file_num
+
+    def uses_field_dicts(self, tag: set) -> bool:
+        return len(tag) != 0 and len(self.field_dicts) != 0 and tags_to_mask("".join(tag)) != -1
+
+    def lookup(self, word: str, tag: set):
+        """Term dictionary entry of the smallest postings list holding the documents of the word in the query fields"""
+        if not self.uses_field_dicts(tag):
+            return self.term_dict.lookup(word)
+
+        entries = [self.field_dicts[field].lookup(word) for field in tag]
+        if None in entries:
+            return None
+        return min(entries, key=lambda e: e[3])
+
+    def low_entry(self, word: str, tag: set):
+        """Low tier dictionary entry of a word split in impact tiers, None if it is not split or the query fields are
+        read from their own postings lists. The entry of a pruned low tier only gives its doc frequency and max count"""
+        if self.low_dict is None or self.uses_field_dicts(tag):
+            return None
+        return self.low_dict.lookup(word)
+
+    def entries(self, word: str, tag: set, tier: str = None) -> tuple:
+        """Term dictionary entries of the stored postings lists read for the word in the query fields, the "top" tier
+        only reads the top impact tier of a word split in tiers and the "low" tier only its low tier"""
+        entries = []
+        if tier != "low" and (entry := self.lookup(word, tag)) is not None:
+            entries.append(entry)
+        if tier != "top" and not self.pruned and (entry := self.low_entry(word, tag)) is not None:
+            entries.append(entry)
+        return tuple(entries)
+
+    def read_ranges(self, ranges: list, executor=None):
+        """Yield the bytes of the (file, byte offset, length) ranges in order, all read at once by the executor"""
+        if executor is None:
+            for name, offset, length in ranges:
+                yield self.store.data(name)[offset:offset + length]
+            return
+        for future in [executor.submit(self.store.read, name, offset, length) for name, offset, length in ranges]:
+            yield future.result()
+
+    def decode_entries(self, entries: list, executor=None):
+        """Yield the (doc ids, counts, field masks) of the postings lists of term dictionary entries in order"""
+        ranges = [(self.postings_file(entry[0]), entry[1], entry[2]) for entry in entries]
+        for data in self.read_ranges(ranges, executor):
+            if self.postings_format == "binary":
+                yield decode_postings(data)
+            else:
+                yield parse_text_postings(bytes(data).decode().split(" ")[1:])
+
+    def read_postings(self, words: dict, tier: str = None, executor=None) -> dict:
+        """Read the live (doc ids, counts, field masks, max count) of each key of words, mapped to a word and its
+        query fields, from the postings lists of the given impact tier"""
+        source_keys = {}
+        token_set = {}
+        for key, (word, tag) in words.items():
+            if self.term_dict is not None:
+                entries = self.entries(word, tag, tier)
+                if len(entries):
+                    source_keys.setdefault(entries, []).append(key)
+                continue
+            file_num = self.file_of(word)
+            if file_num != 0:
+                source_keys.setdefault(word, []).append(key)
+                token_set.setdefault(file_num, set()).add(word)
+
+        postings = {}
+        if self.term_dict is not None:
+            entries = sorted({entry for entries in source_keys for entry in entries})
+            decoded = dict(zip(entries, self.decode_entries(entries, executor)))
+            for entries in source_keys:
+                postings[entries] = merge_tiers([decoded[entry] for entry in entries]) + (
+                    max(entry[4] for entry in entries),)
+
+        for file, sources in token_set.items():
+            with open(os.path.join(self.path, f"index2_{file}.{POSTINGS_EXTENSION[self.postings_format]}"), 'r') as f:
+                for _line in f:
+                    if len(sources) == 0:
+                        break
+                    token_line = _line.rstrip().split(" ")
+                    word = token_line[0]
+                    if word not in sources:
+                        continue
+                    sources.remove(word)
+                    doc_ids, counts, masks = parse_text_postings(token_line[1:])
+                    postings[word] = (doc_ids, counts, masks, max(counts))
+
+        if len(self.deleted) or self.base:
+            for source, (doc_ids, counts, masks, max_count) in postings.items():
+                keep = [ind for ind, doc in enumerate(doc_ids) if doc not in self.deleted]
+                postings[source] = ([doc_ids[ind] + self.base for ind in keep], [counts[ind] for ind in keep],
+                                    bytearray(masks[ind] for ind in keep), max_count)
+        return {key: postings[source] for source, keys in source_keys.items() if source in postings for key in keys}
+
+    def postings_file(self, file_num: int) -> str:
+        return f"index2_{file_num}.{POSTINGS_EXTENSION[self.postings_format]}"
+
+    def postings_data(self, file_num: int):
+        """Memory mapped postings of an index file"""
+        return self.store.data(self.postings_file(file_num))
+
+    def doc_freq(self, word: str, tag: set) -> int:
+        """Number of documents, deleted ones included, of the postings list read for the word in the query fields,
+        the documents of a pruned low tier included"""
+        if self.term_dict is None:
+            postings = self.read_postings({word: (word, tag)})
+            return len(postings[word][0]) if word in postings else 0
+        entry = self.lookup(word, tag)
+        low_entry = self.low_entry(word, tag)
+        return (entry[3] if entry is not None else 0) + (low_entry[3] if low_entry is not None else 0)
+
+    def pruned_doc_freq(self, word: str, tag: set) -> int:
+        """Number of documents of the word in the query fields dropped from the index by pruning"""
+        low_entry = self.low_entry(word, tag) if self.pruned else None
+        return low_entry[3] if low_entry is not None else 0
+
+    def probe_postings(self, words: dict, docs: list, tier: str = None, executor=None) -> dict:
+        """Postings of each key of words as read_postings, restricted to the sorted global doc ids docs"""
+        local_docs = [doc - self.base for doc in docs[bisect.bisect_right(docs, self.base):bisect.bisect_right(
+            docs, self.base + self.doc_count)] if doc - self.base not in self.deleted]
+        if len(local_docs) == 0:
+            return {}
+
+        postings = {}
+        full_words = {}
+        for key, (word, tag) in words.items():
+            entries = self.entries(word, tag, tier) if self.term_dict is not None else ()
+            if self.skips and len(entries) and all(skip_table_size(entry[3]) for entry in entries):
+                doc_ids, counts, masks = merge_tiers([self.probe_entry(entry, local_docs) for entry in entries])
+                postings[key] = ([doc + self.base for doc in doc_ids], counts, masks, max(e[4] for e in entries))
+            elif len(entries) or self.term_dict is None:
+                full_words[key] = (word, tag)
+
+        wanted = set(docs)
+        for key, (doc_ids, counts, masks, max_count) in self.read_postings(full_words, tier, executor).items():
+            keep = [ind for ind, doc in enumerate(doc_ids) if doc in wanted]
+            postings[key] = ([doc_ids[ind] for ind in keep], [counts[ind] for ind in keep],
+                             bytearray(masks[ind] for ind in keep), max_count)
+        return postings
+
+    def probe_entry(self, entry: tuple, local_docs: list) -> tuple:
+        """(doc ids, counts, field masks) of the local docs found in a binary postings list with skips, the skip
+        table gives the block of each document"""
+        file_num, offset, length, doc_freq = entry[:4]
+        skip_size = skip_table_size(doc_freq)
+        doc_ids, counts, masks = [], [], bytearray()
+        data = self.postings_data(file_num)
+        last_docs, block_offsets = decode_skips(data[offset + length - skip_size:offset + length])
+        blocks = sorted({bisect.bisect_left(last_docs, doc) for doc in local_docs} - {len(last_docs)})
+        for block in blocks:
+            decode_block(data, offset + block_offsets[block], last_docs[block - 1] if block else 0,
+                         min(BLOCK_SIZE, doc_freq - block * BLOCK_SIZE), doc_ids, counts, masks)
+        wanted = set(local_docs)
+        keep = [ind for ind, doc in enumerate(doc_ids) if doc in wanted]
+        return [doc_ids[ind] for ind in keep], [counts[ind] for ind in keep], bytearray(masks[ind] for ind in keep)
+
+    def title(self, doc: int) -> tuple:
+        """(title, wikipedia page id) of a local doc id, indexes without a title offsets table are read line by line"""
+        if self.title_store is not None:
+            return self.title_store.lookup(doc)
+
+        file_num = (doc - 1) // self.file_per_page + 1
+        with open(os.path.join(self.path, title_file(file_num)), 'r') as f:
+            title = next(islice(f, (doc - 1) % self.file_per_page, None)).rstrip()
+        with open(os.path.join(self.path, PAGE_IDS_FILE), 'r') as f:
+            page_id = next(islice(f, doc - 1, None)).rstrip()
+        return title, int(page_id) if page_id.isdigit() else 0
+
+    def read_title(self, doc: int) -> tuple:
+        """(title, wikipedia page id) of a local doc id as title, read by pread so that the titles of the results can
+        be read by concurrent threads"""
+        if self.title_store is not None:
+            return self.title_store.read(doc)
+        return self.title(doc)
+
+    def close(self) -> None:
+        self.store.close()
+
+    def titles(self):
+        """Titles of all the documents in local doc id order"""
+        file_num = 1
+        while os.path.exists(title_path := os.path.join(self.path, title_file(file_num))):
+            with open(title_path, 'r') as f:
+                for line in f:
+                    yield line.rstrip("\n")
+            file_num += 1
+
+    def page_ids(self) -> list:
+        with open(os.path.join(self.path, PAGE_IDS_FILE), 'r') as f:
+            return [line.rstrip() for line in f]
+
+    def iter_postings(self):
+        """(term, doc ids, counts, field masks) of every term of the segment in sorted order with both its impact
+        tiers, without applying the deletes and base"""
+        for ind in range(len(self.term_dict)):
+            term = self.term_dict.term(ind).rstrip(b"\0").decode()
+            entries = [self.term_dict.entry(ind)]
+            if not self.pruned and (low_entry := self.low_entry(term, set())) is not None:
+                entries.append(low_entry)
+            yield (term,) + merge_tiers(list(self.decode_entries(entries)))
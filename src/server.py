@@ -0,0 +1,164 @@
+#!/usr/bin/python
+import argparse
+import asyncio
+import json
+import socket
+import threading
+import timeit
+import traceback
+
+from instrument import INSTRUMENT
+from cache import ResultCache
+from search import SearchHandler
+
+
+def parse_address(address: str) -> tuple:
+    """host:port addresses are served over TCP, anything else is the path of a Unix socket"""
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        return host or "127.0.0.1", int(port)
+    return address, None
+
+
+def connect(address: str) -> socket.socket:
+    host, port = parse_address(address)
+    if port is None:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(host)
+        return conn
+    return socket.create_connection((host, port))
+
+
+def send_request(address: str, request: dict) -> dict:
+    """Send a single JSON request to a running server and wait for its response"""
+    conn = connect(address)
+    with conn, conn.makefile('rwb') as f:
+        f.write(json.dumps(request).encode() + b"\n")
+        f.flush()
+        return json.loads(f.readline())
+
+
+def check_request(request) -> int:
+    """Number of results asked by a request, which must be a JSON object asking for at least one result"""
+    if not isinstance(request, dict):
+        raise TypeError(f"a request is a JSON object, not {type(request).__name__}")
+    try:
+        k = int(request.get("k", 10))
+    except OverflowError:
+        raise ValueError(f"k must be a finite number, got {request['k']}")
+    if k < 1:
+        raise ValueError(f"k must be at least 1, got {k}")
+    return k
+
+
+def error_response(error: Exception) -> dict:
+    """Response to a request which failed, the errors not caused by a bad request are also logged"""
+    if not isinstance(error, (ValueError, KeyError, TypeError)):
+        traceback.print_exception(type(error), error, error.__traceback__)
+    return {"error": f"{type(error).__name__}: {error}"}
+
+
+class SearchServer:
+    """Resident Search Server keeping the index loaded between queries, answering one line of JSON per request"""
+
+    def __init__(self, handler: SearchHandler):
+        self.handler = handler
+        self.lock = threading.Lock()
+
+    def answer(self, request: dict) -> dict:
+        """Run a request on the search handler, the handler keeps per query state so queries take turns"""
+        k = check_request(request)
+        if request.get("stats"):
+            cache = self.handler.postings_cache
+            result_cache = self.handler.result_cache
+            return {"postings_cache": cache.stats() if cache is not None else None,
+                    "result_cache": result_cache.stats() if result_cache is not None else None,
+                    "instrument": INSTRUMENT.report() if INSTRUMENT.enabled else None}
+
+        with self.lock:
+            start = timeit.default_timer()
+            default_results = self.handler.search_results
+            self.handler.search_results = k
+            self.handler.conjunctive = request.get("mode") == "and"
+            try:
+                if request.get("collect"):
+                    return {"stats": self.handler.shard_stats(str(request["query"]))}
+                if "global" in request:
+                    results = self.handler.search_shard(str(request["query"]), request["global"])
+                else:
+                    results = self.handler.search(str(request["query"]))
+            finally:
+                self.handler.search_results = default_results
+                self.handler.conjunctive = False
+                self.handler.reset()
+            stop = timeit.default_timer()
+
+        return {"results": [{"doc_id": doc, "score": score, "title": title, "page_id": page_id}
+                            for doc, score, title, page_id in results],
+                "time": stop - start}
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Answer the requests of a client until it closes the connection"""
+        loop = asyncio.get_running_loop()
+        try:
+            while line := await reader.readline():
+                try:
+                    response = await loop.run_in_executor(None, self.answer, json.loads(line))
+                except Exception as e:
+                    response = error_response(e)
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, address: str) -> None:
+        host, port = parse_address(address)
+        if port is None:
+            server = await asyncio.start_unix_server(self.handle_client, path=host)
+        else:
+            server = await asyncio.start_server(self.handle_client, host=host, port=port)
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(usage="python3 server.py path_to_inverted_index host:port|unix_socket_path "
+                                               "[options]")
+    arg_parser.add_argument("path_to_index")
+    arg_parser.add_argument("address")
+    arg_parser.add_argument("--cache-mb", type=float, default=256,
+                            help="memory budget of the postings cache, 0 disables it")
+    arg_parser.add_argument("--instrument", action="store_true",
+                            help="time the search phases and count the work done, reported by the stats request")
+    arg_parser.add_argument("--scoring", choices=["bm15", "bm25"], default="bm15",
+                            help="bm25 also normalizes the scores by the document lengths")
+    arg_parser.add_argument("--top-tiers", action="store_true",
+                            help="rank the top impact tiers of an index split in tiers without reading its low tiers")
+    arg_parser.add_argument("--io-workers", type=int, default=8,
+                            help="number of threads reading the postings lists and titles of a query concurrently")
+    arg_parser.add_argument("--result-cache-mb", type=float, default=64,
+                            help="memory budget of the cache of query results, 0 disables it")
+    arg_parser.add_argument("--result-ttl", type=float, default=0,
+                            help="seconds a cached result is served for, 0 keeps it until the index changes")
+    arg_parser.add_argument("--result-cache-file", default=None,
+                            help="SQLite file keeping the cached results across restarts")
+    args = arg_parser.parse_args()
+
+    if args.instrument:
+        INSTRUMENT.enable()
+    result_cache = None
+    if args.result_cache_mb > 0:
+        result_cache = ResultCache(int(args.result_cache_mb * 1e6), ttl=args.result_ttl or None,
+                                   path=args.result_cache_file)
+    server = SearchServer(SearchHandler(args.path_to_index, cache_bytes=int(args.cache_mb * 1e6),
+                                        scoring=args.scoring, result_cache=result_cache, top_tiers=args.top_tiers,
+                                        io_workers=args.io_workers))
+    print(f"Serving {args.path_to_index} on {args.address}")
+    try:
+        asyncio.run(server.serve(args.address))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
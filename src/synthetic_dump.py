@@ -0,0 +1,167 @@
+#!/usr/bin/python
+import argparse
+import bz2
+from itertools import accumulate
+import random
+from xml.sax.saxutils import escape
+
+SYLLABLES = ["ka", "ri", "to", "ma", "in", "dia", "pur", "jai", "del", "hi", "met", "ro", "ban", "gal", "ore", "chen",
+             "nai", "lon", "don", "par", "is", "ber", "lin", "cit", "pink", "gov", "nat", "ion", "sha", "vel", "mun",
+             "tor", "el", "an", "ul", "que", "stra", "bor", "ny", "ax"]
+FUNCTION_WORDS = ["the", "of", "and", "in", "a", "to", "was", "is", "for", "on", "as", "by", "with", "his", "at",
+                  "from", "it", "an", "were", "which", "also", "be", "has", "had", "first", "after", "its"]
+INFOBOX_TYPES = ["settlement", "person", "film", "company", "river", "album", "school", "football biography"]
+SECTIONS = ["History", "Geography", "Early life", "Career", "Demographics", "Economy", "Reception", "Legacy"]
+SKIPPED_NAMESPACES = ["Category:", "Template:", "Wikipedia:", "File:", "Portal:", "Help:"]
+PAGES_PER_STREAM = 100
+
+
+class SyntheticDump:
+    """Deterministic generator of MediaWiki XML pages with infoboxes, ref tags, citations, categories, references
+    and external links sections. Words follow a Zipf distribution over a made up vocabulary so that postings list
+    lengths look like those of a real dump"""
+
+    def __init__(self, seed: int = 1, vocabulary_size: int = 50000):
+        self.random = random.Random(seed)
+        words = set()
+        while len(words) < vocabulary_size:
+            words.add("".join(self.random.choice(SYLLABLES) for _ in range(self.random.randint(1, 4))))
+        words = sorted(words)
+        self.random.shuffle(words)
+        self.vocabulary = FUNCTION_WORDS + words
+        self.cum_weights = list(accumulate(1 / rank for rank in range(1, len(self.vocabulary) + 1)))
+        self.categories = [self.words(2).title() for _ in range(max(10, vocabulary_size // 50))]
+
+    def words(self, count: int) -> str:
+        return " ".join(self.random.choices(self.vocabulary, cum_weights=self.cum_weights, k=count))
+
+    def rare_word(self) -> str:
+        """Word from the less frequent half of the vocabulary"""
+        return self.vocabulary[self.random.randrange(len(self.vocabulary) // 2, len(self.vocabulary))]
+
+    def sentence(self) -> str:
+        words = self.words(self.random.randint(8, 30)).split(" ")
+        if self.random.random() < .3:
+            ind = self.random.randrange(len(words))
+            words[ind] = f"[[{words[ind].title()}]]" if self.random.random() < .5 else \
+                f"[[{self.rare_word().title()}|{words[ind]}]]"
+        if self.random.random() < .1:
+            words.append(str(self.random.randint(1000, 2024)))
+        return " ".join(words).capitalize() + "."
+
+    def citation(self, name: str) -> str:
+        if self.random.random() < .2:
+            return f'<ref name="{name}" />'
+        url = f"http://www.{self.rare_word()}.com/{self.rare_word()}.html"
+        if self.random.random() < .6:
+            body = f"{{{{cite web |url={url} |title={self.words(4).title()} |publisher={self.words(2).title()} " \
+                   f"|access-date={self.random.randint(1, 28)} March {self.random.randint(2005, 2024)}}}}}"
+        else:
+            body = f"{self.words(5).capitalize()}, p. {self.random.randint(1, 400)}"
+        return f'<ref name="{name}">{body}</ref>' if self.random.random() < .3 else f"<ref>{body}</ref>"
+
+    def paragraph(self) -> str:
+        sentences = []
+        for _ in range(self.random.randint(2, 8)):
+            sentence = self.sentence()
+            if self.random.random() < .35:
+                sentence += self.citation(self.rare_word())
+            sentences.append(sentence)
+        return " ".join(sentences)
+
+    def infobox(self, title: str) -> str:
+        fields = [f"| name = {title}"]
+        for _ in range(self.random.randint(3, 12)):
+            value = self.words(self.random.randint(1, 5))
+            if self.random.random() < .15:
+                value += self.citation(self.rare_word())
+            fields.append(f"| {self.rare_word()}_{self.rare_word()} = {value}")
+        return f"{{{{Infobox {self.random.choice(INFOBOX_TYPES)}\n" + "\n".join(fields) + "\n}}"
+
+    def page_text(self, title: str) -> str:
+        parts = []
+        if self.random.random() < .4:
+            parts.append(f"{{{{short description|{self.words(4).capitalize()}}}}}")
+        if self.random.random() < .5:
+            parts.append(self.infobox(title))
+        parts.append(f"'''{title}''' " + self.paragraph())
+        for section in self.random.sample(SECTIONS, self.random.randint(0, 4)):
+            paragraphs = [self.paragraph() for _ in range(self.random.randint(1, 3))]
+            parts.append(f"=={section}==\n" + "\n\n".join(paragraphs))
+        if self.random.random() < .6:
+            references = "==References==\n{{reflist}}"
+            if self.random.random() < .3:
+                books = "\n".join(f"* {self.words(6).capitalize()} ({self.random.randint(1950, 2024)})"
+                                  for _ in range(2))
+                references += "\n{{refbegin}}\n" + books + "\n{{refend}}"
+            parts.append(references)
+        if self.random.random() < .5:
+            parts.append("==External links==\n" + "\n".join(
+                f"* [http://www.{self.rare_word()}.org {self.words(3).capitalize()}]"
+                for _ in range(self.random.randint(1, 4))))
+        parts.append("\n".join(f"[[Category:{category}]]" for category in
+                               self.random.sample(self.categories, self.random.randint(0, 5))))
+        return "\n\n".join(parts)
+
+    def page(self, page_id: int) -> str:
+        title = self.words(self.random.randint(1, 4)).title()
+        if self.random.random() < .03:
+            title = self.random.choice(SKIPPED_NAMESPACES) + title
+        return f"  <page>\n    <title>{escape(title)}</title>\n    <ns>0</ns>\n    <id>{page_id}</id>\n" \
+               f"    <revision>\n      <id>{page_id * 7 + 1}</id>\n" \
+               f"      <text xml:space=\"preserve\">{escape(self.page_text(title))}</text>\n" \
+               f"    </revision>\n  </page>\n"
+
+    def query(self) -> str:
+        """Query of one to three words, sometimes restricted to fields"""
+        words = [self.rare_word() if self.random.random() < .5 else self.words(1)
+                 for _ in range(self.random.randint(1, 3))]
+        if self.random.random() < .3:
+            words = [f"{self.random.choice('tibcrl')}:{word}" for word in words]
+        return " ".join(words)
+
+
+def page_title(page: str) -> str:
+    return page[page.index("<title>") + len("<title>"):page.index("</title>")]
+
+
+def write_dump(path: str, pages: int, seed: int = 1, vocabulary_size: int = 50000) -> None:
+    """Write a synthetic dump, a path ending in .xml.bz2 gives a multistream dump with its -index.txt.bz2 file"""
+    dump = SyntheticDump(seed=seed, vocabulary_size=vocabulary_size)
+    header = "<mediawiki>\n  <siteinfo>\n    <sitename>Wikipedia</sitename>\n  </siteinfo>\n"
+    footer = "</mediawiki>\n"
+    if not path.endswith(".xml.bz2"):
+        with open(path, 'w') as f:
+            f.write(header)
+            for page_id in range(1, pages + 1):
+                f.write(dump.page(page_id * 3))
+            f.write(footer)
+        return
+
+    index_lines = []
+    with open(path, 'wb') as f:
+        f.write(bz2.compress(header.encode()))
+        for start in range(1, pages + 1, PAGES_PER_STREAM):
+            offset = f.tell()
+            stream = []
+            for page_id in range(start, min(start + PAGES_PER_STREAM, pages + 1)):
+                stream.append(dump.page(page_id * 3))
+                index_lines.append(f"{offset}:{page_id * 3}:{page_title(stream[-1])}\n")
+            f.write(bz2.compress("".join(stream).encode()))
+        f.write(bz2.compress(footer.encode()))
+    with bz2.open(path[:-len(".xml.bz2")] + "-index.txt.bz2", 'wt', encoding='utf-8') as f:
+        f.write("".join(index_lines))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Generate a synthetic Wikipedia dump")
+    arg_parser.add_argument("path_to_dump", help="output file, a .xml.bz2 path writes a multistream dump")
+    arg_parser.add_argument("--pages", type=int, default=10000, help="number of pages")
+    arg_parser.add_argument("--seed", type=int, default=1, help="seed of the generator")
+    arg_parser.add_argument("--vocabulary-size", type=int, default=50000, help="number of distinct made up words")
+    args = arg_parser.parse_args()
+    write_dump(args.path_to_dump, args.pages, seed=args.seed, vocabulary_size=args.vocabulary_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import re
+import sys
+
+import Stemmer
+
+from stopwords import STOPWORDS
+
+STEMMER = Stemmer.Stemmer('english')
+GARBAGE_REGEX = re.compile(r"\d+[a-z]+\d|[a-z]+\d+[a-z]|([a-z])\1{2,}")
+DROP = -1
+# Bytes taken by a term or a memoized word besides its characters: the string, its dict entry and list slot
+TERM_OVERHEAD = sys.getsizeof("") + 112
+MEMO_OVERHEAD = sys.getsizeof("") + 104
+
+
+def keep_term(term: str) -> bool:
+    """Cleaning of Stemmed Tokens"""
+    return term[0:2] != "00" and len(term) <= 20 and (
+            (not term.isdigit() and not GARBAGE_REGEX.match(term)) or (len(term) <= 4 and term.isdigit()))
+
+
+class Vocabulary:
+    """Integer ids of the stemmed terms seen since the last reset. The term id, or DROP for stopwords and removed
+    terms, of each raw word is memoized in a cache bounded to max_words words so that stopword removal, stemming and
+    cleaning run once per distinct word"""
+
+    def __init__(self, max_words: int = 1 << 20):
+        self.max_words = max_words
+        self.memo = {}
+        self.memo_bytes = 0
+        self.term_ids = {}
+        self.terms = []
+        self.term_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+    @property
+    def memory(self) -> int:
+        """Estimated bytes held by the terms and the memo"""
+        return self.term_bytes + self.memo_bytes
+
+    def term(self, term_id: int) -> str:
+        return self.terms[term_id]
+
+    def add_term(self, term: str) -> int:
+        """Id of a stemmed term, new terms get the next id"""
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            term_id = self.term_ids[term] = len(self.terms)
+            self.terms.append(term)
+            self.term_bytes += TERM_OVERHEAD + len(term)
+        return term_id
+
+    def lookup(self, words: list) -> list:
+        """Term ids of the kept words, in order"""
+        memo = self.memo
+        missing = list({word for word in words if word not in memo})
+        if len(missing):
+            if len(memo) + len(missing) > self.max_words:
+                memo.clear()
+                self.memo_bytes = 0
+            kept = [word for word in missing if word not in STOPWORDS]
+            for word in missing:
+                memo[word] = DROP
+            for word, term in zip(kept, STEMMER.stemWords(kept)):
+                if keep_term(term):
+                    memo[word] = self.add_term(term)
+            self.memo_bytes += sum(len(word) for word in missing) + MEMO_OVERHEAD * len(missing)
+
+        return [term_id for term_id in map(memo.__getitem__, words) if term_id != DROP]
+
+    def stem(self, words: list) -> list:
+        """Stemmed terms of the kept words, in order"""
+        return [self.terms[term_id] for term_id in self.lookup(words)]
+
+    def reset(self) -> None:
+        """Forget all the terms and, as it refers to their ids, the memo"""
+        self.memo = {}
+        self.memo_bytes = 0
+        self.term_ids = {}
+        self.terms = []
+        self.term_bytes = 0
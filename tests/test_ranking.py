@@ -0,0 +1,63 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+SRC = os.path.join(os.path.dirname(__file__), "..", "src")
+sys.path.insert(0, SRC)
+
+from search import SearchHandler, np  # noqa: E402
+from synthetic_dump import SyntheticDump, write_dump  # noqa: E402
+
+
+def index(*args) -> None:
+    subprocess.run([sys.executable, os.path.join(SRC, "indexer.py")] + [str(arg) for arg in args], check=True,
+                   stdout=subprocess.DEVNULL)
+
+
+def exhaustive(handler: SearchHandler, query: str, k: int) -> list:
+    """Top (doc id, score) of a query found by scoring every document of its postings lists"""
+    handler.load_segments()
+    handler.parse_query(query)
+    handler.get_index()
+    scores = {}
+    for word in handler.term_order:
+        if word not in handler.index:
+            continue
+        for doc, tf in zip(*handler.index[word]):
+            norm = handler.doc_norm(handler.doc_lengths[doc]) if handler.doc_lengths is not None else 1.0
+            scores[doc] = scores.get(doc, 0) + handler.token_dict[word]["count"] * handler.scoring_func(
+                tf, handler.idf[word], norm)
+    handler.reset()
+    return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:k]
+
+
+@pytest.fixture(scope="module")
+def indexes(tmp_path_factory):
+    path = tmp_path_factory.mktemp("ranking")
+    write_dump(str(path / "dump.xml"), 500, seed=7, vocabulary_size=2000)
+    index(path / "dump.xml", path / "plain", path / "stats.txt", "--postings", "binary")
+    index(path / "dump.xml", path / "tiered", path / "stats.txt", "--postings", "binary", "--tier-docs", 20)
+    dump = SyntheticDump(seed=7, vocabulary_size=2000)
+    return path, [dump.query() for _ in range(80)] + ["the of and", "t:the in"]
+
+
+@pytest.mark.parametrize("scoring", ["bm15", "bm25"])
+@pytest.mark.parametrize("vectorized", [False, True])
+def test_top_k_matches_exhaustive_scoring(indexes, scoring, vectorized):
+    """MaxScore, the NumPy scoring and the tiered ranking return the top documents of exhaustive scoring"""
+    if vectorized and np is None:
+        pytest.skip("NumPy is not installed")
+    path, queries = indexes
+    reference = SearchHandler(str(path / "plain"), scoring=scoring)
+    for name in ("plain", "tiered"):
+        handler = SearchHandler(str(path / name), scoring=scoring)
+        handler.vectorized = vectorized
+        for k in (1, 10, 100):
+            handler.search_results = k
+            for query in queries:
+                expected = exhaustive(reference, query, k)
+                results = [(doc, score) for doc, score, _, _ in handler.search(query)]
+                assert [doc for doc, _ in results] == [doc for doc, _ in expected], (name, k, query)
+                assert [score for _, score in results] == pytest.approx([score for _, score in expected]), query
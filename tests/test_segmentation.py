@@ -0,0 +1,28 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from processing import VOCABULARY, process_data  # noqa: E402
+
+CORPUS_FILE = os.path.join(os.path.dirname(__file__), "segmentation_corpus.jsonl")
+# The single pass segmenter only differs from the per-section regex passes on malformed markup, which the passes cut
+# out in another order, so the corpus leaves it out:
+# - an unclosed [[Category: link no longer ends an External links section
+# - an unclosed [[Category: link runs to the next ]] as category text, over the refs and references sections which the
+#   passes cut out first
+# - a ref, or a < left open up to a later self closing tag, which spans a blank line in an External links section is
+#   cut at the blank line ending the section instead of being cut out first
+
+
+def test_postings_match_corpus():
+    """The postings of each page of the corpus, the weighted count and field tags of each stemmed term, are those
+    written by the per-section regex passes the single pass segmenter replaced"""
+    with open(CORPUS_FILE, 'r') as f:
+        corpus = [json.loads(line) for line in f]
+    for doc_id, page in enumerate(corpus, start=1):
+        doc_dict = process_data(ID=doc_id, title=page["title"], text=page["text"])
+        postings = {VOCABULARY.term(term_id): [val["count"], "".join(sorted(val["pos"]))]
+                    for term_id, val in doc_dict.items()}
+        assert postings == page["postings"], page["text"]
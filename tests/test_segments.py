@@ -0,0 +1,63 @@
+import os
+import subprocess
+import sys
+from xml.sax.saxutils import escape
+
+SRC = os.path.join(os.path.dirname(__file__), "..", "src")
+sys.path.insert(0, SRC)
+
+from search import SearchHandler  # noqa: E402
+from synthetic_dump import SyntheticDump  # noqa: E402
+
+
+def write_pages(path, pages: list) -> None:
+    """Write a dump of (page id, title, text) pages"""
+    with open(path, 'w') as f:
+        f.write("<mediawiki>\n")
+        for page_id, title, text in pages:
+            f.write(f"  <page>\n    <title>{escape(title)}</title>\n    <id>{page_id}</id>\n    <revision>\n"
+                    f"      <id>{page_id * 7 + 1}</id>\n      <text>{escape(text)}</text>\n"
+                    f"    </revision>\n  </page>\n")
+        f.write("</mediawiki>\n")
+
+
+def index(*args) -> None:
+    subprocess.run([sys.executable, os.path.join(SRC, "indexer.py")] + [str(arg) for arg in args], check=True,
+                   stdout=subprocess.DEVNULL)
+
+
+def all_results(index_path, queries: list) -> list:
+    """(page id, score) of every document matching each query"""
+    handler = SearchHandler(str(index_path))
+    handler.search_results = 1 << 20
+    return [sorted((page_id, round(score, 9)) for _, score, _, page_id in handler.search(query)) for query in queries]
+
+
+def test_segment_adds_match_rebuild(tmp_path):
+    """Adding a dump of changed, new, deleted and no longer indexed pages as a segment leaves the documents and scores
+    of an index rebuilt from the live pages"""
+    dump = SyntheticDump(seed=3, vocabulary_size=2000)
+
+    def page(page_id: int, namespace: str = "") -> tuple:
+        title = namespace + dump.words(2).title()
+        return page_id, title, dump.page_text(title)
+
+    first = [page(page_id) for page_id in range(1, 301)]
+    second = [page(page_id) for page_id in range(1, 61)] + [page(page_id, "Template:") for page_id in range(61, 81)] + \
+        [page(page_id) for page_id in range(301, 341)]
+    deleted = set(range(81, 91))
+    live = [p for p in first if p[0] not in {q[0] for q in second} | deleted] + second
+    write_pages(tmp_path / "first.xml", first)
+    write_pages(tmp_path / "second.xml", second)
+    write_pages(tmp_path / "live.xml", live)
+    with open(tmp_path / "deleted.txt", 'w') as f:
+        f.write("".join(f"{page_id}\n" for page_id in deleted))
+
+    stats = tmp_path / "stats.txt"
+    index(tmp_path / "first.xml", tmp_path / "segmented", stats, "--segment")
+    index(tmp_path / "second.xml", tmp_path / "segmented", stats, "--segment", "--delete-pages",
+          tmp_path / "deleted.txt")
+    index(tmp_path / "live.xml", tmp_path / "rebuilt", stats)
+
+    queries = [dump.query() for _ in range(100)] + [p[1].split(" ")[0] for p in first[:100]]
+    assert all_results(tmp_path / "segmented", queries) == all_results(tmp_path / "rebuilt", queries)
@@ -0,0 +1,40 @@
+import os
+import subprocess
+import sys
+
+SRC = os.path.join(os.path.dirname(__file__), "..", "src")
+sys.path.insert(0, SRC)
+
+from coordinator import ShardCoordinator, open_shards  # noqa: E402
+from search import SearchHandler  # noqa: E402
+from synthetic_dump import SyntheticDump, write_dump  # noqa: E402
+
+
+def index(*args) -> None:
+    subprocess.run([sys.executable, os.path.join(SRC, "indexer.py")] + [str(arg) for arg in args], check=True,
+                   stdout=subprocess.DEVNULL)
+
+
+def test_sharded_results_match_unsharded(tmp_path):
+    """The coordinator merges the top results of the shards into the doc ids, scores and titles of the unsharded
+    index, for both scorings and in AND mode"""
+    write_dump(str(tmp_path / "dump.xml"), 400, seed=5, vocabulary_size=2000)
+    index(tmp_path / "dump.xml", tmp_path / "whole", tmp_path / "stats.txt", "--postings", "binary")
+    index(tmp_path / "dump.xml", tmp_path / "sharded", tmp_path / "stats.txt", "--postings", "binary", "--shards", 3)
+    dump = SyntheticDump(seed=5, vocabulary_size=2000)
+    queries = [dump.query() for _ in range(60)]
+
+    for scoring in ("bm15", "bm25"):
+        handler = SearchHandler(str(tmp_path / "whole"), scoring=scoring)
+        coordinator = ShardCoordinator(open_shards([str(tmp_path / "sharded")], 0, scoring, 0))
+        try:
+            for mode in (None, "and"):
+                handler.conjunctive = mode == "and"
+                for k in (1, 10, 1000):
+                    handler.search_results = k
+                    for query in queries:
+                        expected = [{"doc_id": doc, "score": score, "title": title, "page_id": page_id}
+                                    for doc, score, title, page_id in handler.search(query)]
+                        assert coordinator.search(query, k, mode) == expected, (scoring, mode, k, query)
+        finally:
+            coordinator.close()